@@ -4,6 +4,15 @@ import math
 import bmesh
 from timeit import default_timer as timer
 import json
+import hashlib
+import queue
+import shutil
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+import numpy as np
 from mathutils import Vector
 from bpy.props import (
     StringProperty,
@@ -32,6 +41,9 @@ imageFile = "image.png"
 waterFile = "water.tif"
 viewFile = "vantage.shp"
 trailFile = "trail.shp"
+packedPatchFile = "patch_pack.png"
+scanPrefix = "scan_"
+manifestFile = "manifest.json"
 dynamic_cam = "dynamic_camera"
 bird_cam = "bird_camera"
 CRS = "EPSG:31370"
@@ -70,34 +82,272 @@ def _ensure_dynamic_camera():
     return cam, tgt
 
 
+# the terrain mesh's (name, verts, loops) and its loop vertex indices;
+# cleared when the terrain is imported again
+_loop_vertex_cache = {}
+
+
+def _loop_vertices(me):
+    # loop -> vertex indices, kept while the mesh topology stays the same
+    key = (me.name, len(me.vertices), len(me.loops))
+    if _loop_vertex_cache.get("key") != key:
+        indices = np.empty(key[2], dtype=np.int32)
+        me.loops.foreach_get("vertex_index", indices)
+        _loop_vertex_cache.update(key=key, indices=indices)
+    return _loop_vertex_cache["indices"]
+
+
 def ensure_planar_uv(obj, uv_name="TL_UV", flip_v=True):
     """Create/refresh UV so UV = normalized world XY over the mesh bbox."""
     me = obj.data
     uv_layer = me.uv_layers.get(uv_name) or me.uv_layers.new(name=uv_name)
     me.uv_layers.active = uv_layer
 
-    mw = obj.matrix_world
-    xs, ys = [], []
-    for v in me.vertices:
-        co = mw @ v.co
-        xs.append(co.x)
-        ys.append(co.y)
-    xmin, xmax = min(xs), max(xs)
-    ymin, ymax = min(ys), max(ys)
-    dx = (xmax - xmin) or 1.0
-    dy = (ymax - ymin) or 1.0
-
-    uv_data = uv_layer.data
-    for loop in me.loops:
-        co = mw @ me.vertices[loop.vertex_index].co
-        u = (co.x - xmin) / dx
-        v = (co.y - ymin) / dy
-        if flip_v:
-            v = 1.0 - v
-        uv_data[loop.index].uv = (u, v)
+    co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get("co", co)
+    mw = np.array(obj.matrix_world)
+    xy = co.reshape(-1, 3) @ mw[:2, :3].T + mw[:2, 3]
+    lo, hi = np.nanmin(xy, axis=0), np.nanmax(xy, axis=0)
+    span = np.where(hi > lo, hi - lo, 1.0)
+
+    uv = (xy[_loop_vertices(me)] - lo) / span
+    if flip_v:
+        uv[:, 1] = 1.0 - uv[:, 1]
+    uv_layer.data.foreach_set("uv", uv.astype(np.float32).ravel())
     return uv_name
 
 
+def read_png_text(path):
+    """tEXt chunks ahead of the image data of a PNG, as a dict."""
+    text = {}
+    with open(path, "rb") as f:
+        if f.read(8) != b"\x89PNG\r\n\x1a\n":
+            return text
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                break
+            length, tag = struct.unpack(">I4s", head)
+            if tag in (b"IDAT", b"IEND"):
+                break
+            data = f.read(length)
+            f.seek(4, 1)  # crc
+            if tag == b"tEXt":
+                key, _, value = data.partition(b"\0")
+                text[key.decode("latin-1")] = value.decode()
+    return text
+
+
+def load_packed_masks(path):
+    """Split a packed patch mask into one density image per class.
+
+    The PNG is loaded once; its tl-manifest text chunk says which band
+    (RGBA) or palette color (indexed) is which class. Returns
+    {class: image} with the values of the separate patch_classN.png files.
+    """
+    manifest = json.loads(read_png_text(path)["tl-manifest"])
+    src = bpy.data.images.load(path, check_existing=False)
+    try:
+        src.colorspace_settings.name = "Non-Color"
+        src.alpha_mode = "CHANNEL_PACKED"  # keep RGB untouched by alpha
+        width, height = src.size
+        pixels = np.empty(width * height * 4, dtype=np.float32)
+        src.pixels.foreach_get(pixels)
+    finally:
+        bpy.data.images.remove(src)
+    pixels = pixels.reshape(-1, 4)
+
+    if manifest["format"] == "rgba":
+        bands = {
+            cls: pixels[:, "RGBA".index(band)]
+            for band, cls in manifest["bands"].items()
+        }
+    else:
+        rgb = np.rint(pixels[:, :3] * 255).astype(np.int32)
+        codes = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        inside, outside = (0.0, 1.0) if manifest["use_subtract"] else (1.0, 0.0)
+        bands = {
+            cls: np.where(codes == ((r << 16) | (g << 8) | b), inside, outside)
+            for cls, (r, g, b) in manifest["palette"].items()
+        }
+
+    images = {}
+    rgba = np.ones((width * height, 4), dtype=np.float32)
+    for cls, band in bands.items():
+        name = f"patch_{cls}"
+        img = bpy.data.images.get(name)
+        if img is not None and (
+            img.source != "GENERATED" or tuple(img.size) != (width, height)
+        ):
+            bpy.data.images.remove(img)
+            img = None
+        if img is None:
+            img = bpy.data.images.new(name, width, height, alpha=False)
+        img.colorspace_settings.name = "Non-Color"
+        rgba[:, :3] = band[:, None]
+        img.pixels.foreach_set(rgba.ravel())
+        img.update()
+        images[cls] = img
+    return images
+
+
+def read_geotiff_tags(path):
+    """Georeferencing and nodata tags of a (classic) GeoTIFF, as a dict.
+
+    "key" holds the pixel scale and tie point, so two files with the same
+    key and size cover the same grid; "nodata" is the GDAL nodata value.
+    """
+    tags = {}
+    with open(path, "rb") as f:
+        head = f.read(8)
+        order = {b"II": "<", b"MM": ">"}.get(head[:2])
+        if order is None or struct.unpack(order + "H", head[2:4])[0] != 42:
+            return tags
+        f.seek(struct.unpack(order + "I", head[4:8])[0])
+        (count,) = struct.unpack(order + "H", f.read(2))
+        entries = f.read(12 * count)
+        values = {}
+        for i in range(count):
+            tag, kind, n, offset = struct.unpack_from(order + "HHII", entries, 12 * i)
+            if tag in (33550, 33922) and kind == 12:  # pixel scale, tie point
+                f.seek(offset)
+                values[tag] = struct.unpack(f"{order}{n}d", f.read(8 * n))
+            elif tag == 42113 and kind == 2:  # GDAL_NODATA, ascii
+                if n <= 4:
+                    raw = entries[12 * i + 8 : 12 * i + 8 + n]
+                else:
+                    f.seek(offset)
+                    raw = f.read(n)
+                try:
+                    tags["nodata"] = float(raw.rstrip(b"\0"))
+                except ValueError:
+                    pass
+    if 33550 in values and 33922 in values:
+        tags["key"] = (values[33550], values[33922])
+    return tags
+
+
+def read_dem(path):
+    """DEM heights, top row first with nodata as NaN, and its grid key.
+
+    Reads with GDAL when Blender's Python has it, else loads the file as
+    a Blender image (integer DEMs come back normalized, which the height
+    fit of terrain_grid absorbs). The key is None if the georeferencing
+    is unknown.
+    """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        gdal = None
+    if gdal is not None:
+        ds = gdal.Open(path)
+        if ds is None:  # unreadable, or still being written
+            raise RuntimeError(f"GDAL cannot open '{path}'")
+        band = ds.GetRasterBand(1)
+        dem = band.ReadAsArray()
+        if dem is None:
+            raise RuntimeError(f"GDAL cannot read '{path}'")
+        dem = dem.astype(np.float64)
+        nodata = band.GetNoDataValue()
+        key = (dem.shape, ds.GetGeoTransform())
+        ds = None
+    else:
+        tags = read_geotiff_tags(path)
+        img = bpy.data.images.load(path, check_existing=False)
+        try:
+            img.colorspace_settings.name = "Non-Color"
+            width, height = img.size
+            pixels = np.empty(width * height * 4, dtype=np.float32)
+            img.pixels.foreach_get(pixels)
+        finally:
+            bpy.data.images.remove(img)
+        # Blender stores the bottom row first
+        dem = pixels.reshape(height, width, 4)[::-1, :, 0].astype(np.float64)
+        nodata = tags.get("nodata")
+        key = (dem.shape, tags["key"]) if "key" in tags else None
+    if nodata is not None:
+        dem[dem == nodata] = np.nan
+    return dem, key
+
+
+def terrain_grid(obj, dem, key, step=2):
+    """Map the vertices of a DEM mesh imported with step back to the DEM.
+
+    The vertex XY lattice must match dem[::step, ::step] and the heights
+    must be an affine function of the DEM values (the importer may scale
+    and offset them), otherwise None: update_terrain then has nothing to
+    go by and the terrain is imported again.
+    """
+    me = obj.data
+    count = len(me.vertices)
+    co = np.empty(count * 3)
+    me.vertices.foreach_get("co", co)
+    co = co.reshape(-1, 3)
+    sub = dem[::step, ::step]
+    xs, cols = np.unique(np.round(co[:, 0], 4), return_inverse=True)
+    ys, rows = np.unique(np.round(co[:, 1], 4), return_inverse=True)
+    if (len(ys), len(xs)) != sub.shape:
+        return None
+    rows = len(ys) - 1 - rows  # y grows upwards, rows downwards
+    index = rows * sub.shape[1] + cols
+    values = sub.ravel()[index]
+    if count < 3 or not np.isfinite(values).all():
+        return None
+    fit = np.column_stack([values, np.ones(count)])
+    (scale, offset), *_ = np.linalg.lstsq(fit, co[:, 2], rcond=None)
+    tolerance = 1e-3 * (np.ptp(co[:, 2]) or 1.0)
+    if np.abs(scale * values + offset - co[:, 2]).max() > tolerance:
+        return None
+    # the rim addSide pulls down to make the sides
+    border = (rows == 0) | (rows == sub.shape[0] - 1)
+    border |= (cols == 0) | (cols == sub.shape[1] - 1)
+    return {
+        "key": key,
+        "step": step,
+        "count": count,
+        "index": index,
+        "scale": scale,
+        "offset": offset,
+        "border": border,
+        "fringe": obj.dimensions.x / 20,
+    }
+
+
+def update_terrain(obj, dem, key, grid):
+    """Write new DEM heights into the terrain mesh in place.
+
+    Returns False, leaving the mesh alone, when grid does not fit: another
+    extent or resolution, another mesh, or nodata where a vertex is. The
+    side material of addSide follows the new face normals.
+    """
+    me = obj.data
+    if grid is None or key is None or key != grid["key"]:
+        return False
+    if len(me.vertices) != grid["count"]:
+        return False
+    step = grid["step"]
+    z = grid["scale"] * dem[::step, ::step].ravel()[grid["index"]] + grid["offset"]
+    if not np.isfinite(z).all():
+        return False
+    z[grid["border"]] = z.min() - grid["fringe"]
+    co = np.empty(grid["count"] * 3)
+    me.vertices.foreach_get("co", co)
+    co[2::3] = z
+    me.vertices.foreach_set("co", co)
+    me.update()
+    top, side = grid.get("materials", (-1, -1))
+    if top >= 0 and side >= 0:
+        # as addSide: faces that point neither up nor down are sides
+        normals = np.empty(len(me.polygons) * 3)
+        me.polygons.foreach_get("normal", normals)
+        sideways = np.abs(normals[2::3]) <= 0.4
+        me.polygons.foreach_set(
+            "material_index", np.where(sideways, side, top).astype(np.int32)
+        )
+        me.update()
+    return True
+
+
 def set_active_uv(obj, uv_name="TL_UV"):
     me = obj.data
     uv = me.uv_layers.get(uv_name)
@@ -145,6 +395,10 @@ class Prefs:
         # self.trail_path = os.path.join(self.watchFolder, trailFile)
         self.CRS = "EPSG:" + getSettings()["CRS"]
         self.timer = getSettings()["timer"]
+        # seconds of Adapt work per timer tick
+        self.budget = getSettings().get("budget", 0.02)
+        # seconds without a new patch mask before the trees are planted
+        self.patch_quiet = getSettings().get("patch_quiet", 0.5)
         self.scale = getSettings()["scale"]
         # self.profile = os.path.join(folder, getSettings()["trail"]["profile"])
         self.trees = {}
@@ -583,6 +837,298 @@ def adjust3Dview(object):
             bpy.ops.view3d.view_selected(overrideContext)
 
 
+def _mark_done(path, watchFolder):
+    # rename a consumed file so it won't be reprocessed
+    try:
+        base_noext = os.path.splitext(os.path.basename(path))[0]
+        done_path = os.path.join(watchFolder, base_noext + ".done")
+        if os.path.exists(done_path):
+            os.remove(done_path)
+        os.replace(path, done_path)
+    except Exception:
+        pass
+
+
+# inotify flags (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+_inotify_event = struct.Struct("iIII")
+
+
+def _change_kind(name):
+    # classify a watch folder file name, None for files we don't consume
+    if name == terrainFile:
+        return "terrain"
+    if name == viewFile:
+        return "view"
+    if name.startswith("patch_") and name.endswith(".png"):
+        return "patch"
+    if name.startswith(scanPrefix):
+        return "scan"
+    return None
+
+
+class FolderWatcher:
+    """Report files arriving in the watch folder.
+
+    On Linux a background thread blocks on an inotify watch for
+    close-write and moved-to events and queues (kind, name) records,
+    so the modal timer only drains a queue. Where inotify is not
+    available the watcher falls back to listing the folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.queue = queue.Queue()
+        self.live = False
+        self._fd = None
+        self._thread = None
+        try:
+            self._start()
+        except (OSError, AttributeError) as e:
+            print(f"Watching {folder} by polling: {e}")
+
+    def _start(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(fd, os.fsencode(self.folder), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, "inotify_add_watch failed")
+        self._fd = fd
+        self._wake = os.pipe()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.live = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._wake[0]], [], [])
+            if self._wake[0] in ready:
+                break
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError:
+                break
+            offset = 0
+            while offset + _inotify_event.size <= len(data):
+                _, mask, _, length = _inotify_event.unpack_from(data, offset)
+                offset += _inotify_event.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, the consumer has to rescan
+                    self.queue.put(("rescan", None))
+                    continue
+                kind = _change_kind(name)
+                if kind:
+                    self.queue.put((kind, name))
+        # tell the consumer to poll from now on
+        self.live = False
+        self.queue.put(("rescan", None))
+
+    def changes(self):
+        """File names to look at on this tick (main thread only)."""
+        names = []
+        rescan = not self.live and self._thread is None
+        while True:
+            try:
+                kind, name = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "rescan":
+                rescan = True
+            elif name not in names:
+                names.append(name)
+        if rescan or not (self.live or names):
+            return os.listdir(self.folder)
+        # a file can be consumed or replaced between the event and the tick
+        return [n for n in names if os.path.exists(os.path.join(self.folder, n))]
+
+    def stop(self):
+        if self._thread is None:
+            return
+        os.write(self._wake[1], b"x")
+        self._thread.join(1)
+        for fd in (self._fd, *self._wake):
+            os.close(fd)
+        self._thread = None
+        self.live = False
+
+
+def _stamp(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class FileBatch:
+    """Collect changed files until none changed for quiet seconds.
+
+    The loose patch_*.png masks of one scan land over several ticks, and
+    planting each as it arrives would clear the classes planted before it.
+    """
+
+    def __init__(self, quiet=0.5):
+        self.quiet = quiet
+        self.files = {}  # name -> stamp
+        self._changed = 0.0
+
+    def add(self, folder, names, now):
+        for name in names:
+            stamp = _stamp(os.path.join(folder, name))
+            if stamp is not None and self.files.get(name) != stamp:
+                self.files[name] = stamp
+                self._changed = now
+
+    def take(self, now):
+        """The collected {name: stamp} once quiet, else an empty dict."""
+        if not self.files or now - self._changed < self.quiet:
+            return {}
+        files, self.files = self.files, {}
+        return files
+
+
+def _remove_unchanged(path, stamp):
+    # a newer file may have replaced it while the update ran
+    if _stamp(path) == stamp:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def clear_folder(folder):
+    """Remove everything in folder, scan directories included."""
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            print("Could not remove file:", name)
+
+
+def run_steps(steps):
+    """Run a step generator to the end."""
+    for _ in steps:
+        pass
+
+
+COMMITTED = "committed"  # yielded by a job that must not be dropped from then on
+
+
+class WorkScheduler:
+    """Run Adapt updates as resumable steps within a time budget per tick.
+
+    A job is a generator that yields between steps. There is at most one
+    job per kind (terrain, view, trees); a job for a newer update drops
+    what is left of the older one, while resubmitting the same key keeps
+    the running job. A job that yielded COMMITTED, like a terrain rebuild
+    whose old mesh is gone, is finished first and the newer one waits
+    for it. step() advances the jobs in kind order until budget seconds
+    are used up; a single step can still overrun it.
+    """
+
+    order = ("terrain", "view", "trees")
+
+    def __init__(self, budget=0.02):
+        self.budget = budget
+        self.jobs = {}  # kind -> job dict
+        self.dropped = 0
+
+    @staticmethod
+    def _job(key, steps):
+        return {"key": key, "steps": steps, "committed": False, "next": None}
+
+    def submit(self, kind, key, steps):
+        job = self.jobs.get(kind)
+        if job is None:
+            self.jobs[kind] = self._job(key, steps)
+            return
+        if job["committed"]:
+            waiting = job["next"]
+            if (waiting or job)["key"] == key:
+                steps.close()  # same update, never started
+                return
+            if waiting is not None:
+                waiting["steps"].close()
+                self.dropped += 1
+            job["next"] = self._job(key, steps)
+            return
+        if job["key"] == key:
+            steps.close()  # same update, never started
+            return
+        job["steps"].close()
+        self.dropped += 1
+        self.jobs[kind] = self._job(key, steps)
+
+    def _finish(self, kind):
+        waiting = self.jobs.pop(kind)["next"]
+        if waiting is not None:
+            self.jobs[kind] = waiting
+
+    def step(self):
+        start = timer()
+        while self.jobs and timer() - start < self.budget:
+            kind = min(self.jobs, key=self.order.index)
+            job = self.jobs[kind]
+            try:
+                if next(job["steps"]) == COMMITTED:
+                    job["committed"] = True
+            except StopIteration:
+                self._finish(kind)
+            except RuntimeError as e:
+                print(f"[{kind}] update failed: {e}")
+                self._finish(kind)
+
+    def clear(self):
+        for job in self.jobs.values():
+            job["steps"].close()
+            if job["next"] is not None:
+                job["next"]["steps"].close()
+        self.jobs.clear()
+
+
+def latest_scan(watchFolder, after=0):
+    """Newest complete scan directory newer than seq after, and its manifest.
+
+    A scan directory is renamed in whole by the producer; the artifacts
+    are still checked against the manifest checksums, so a directory that
+    is being pruned is skipped. Older scan directories are superseded and
+    removed. Returns (None, None) when there is nothing new.
+    """
+    scans = sorted(
+        name for name in os.listdir(watchFolder) if name.startswith(scanPrefix)
+    )
+    for i in reversed(range(len(scans))):
+        folder = os.path.join(watchFolder, scans[i])
+        try:
+            with open(os.path.join(folder, manifestFile)) as f:
+                manifest = json.load(f)
+            if manifest["seq"] <= after:
+                break
+            for name, info in manifest["artifacts"].items():
+                with open(os.path.join(folder, name), "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() != info["sha256"]:
+                        raise ValueError(f"checksum mismatch for {name}")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[scan] skip '{scans[i]}' ({e})")
+            continue
+        for old in scans[:i]:
+            shutil.rmtree(os.path.join(watchFolder, old), ignore_errors=True)
+        return folder, manifest
+    return None, None
+
+
 class Adapt:
     def __init__(self):
         self.plane = "terrain"
@@ -593,12 +1139,36 @@ class Adapt:
         self.view = "vantage"
         # self.trail = "trail"
         self.dimensions = None
+        self.last_scan = 0
+        self.terrain_grid = None
 
     def terrainChange(self, path, imagePath, CRS):
+        run_steps(self.terrain_steps(path, imagePath, CRS))
+
+    def terrain_steps(self, path, imagePath, CRS):
         # TODO: apply previous particle systems
+        stamp = _stamp(path)
+        try:
+            dem, key = read_dem(path)
+        except (OSError, RuntimeError, KeyError, ValueError) as e:
+            print(f"[terrain] cannot read '{path}' ({e})")
+            dem = key = None
+        t_obj = bpy.data.objects.get(self.plane)
+        if dem is None and t_obj is not None:
+            # likely still being written; keep the terrain for the next one
+            return
+        # same grid: only the heights changed, no need to import again
+        if t_obj is not None and update_terrain(t_obj, dem, key, self.terrain_grid):
+            self.dimensions = t_obj.dimensions
+            _remove_unchanged(path, stamp)
+            return
+        yield
+
         adjust_view = True
         if bpy.data.objects.get(self.plane):
             adjust_view = False
+        self.terrain_grid = None  # until the new mesh is complete
+        _loop_vertex_cache.clear()  # the new mesh may reuse the name
         remove_object(self.plane)
         bpy.ops.importgis.georaster(
             filepath=path,
@@ -608,11 +1178,16 @@ class Adapt:
             rastCRS=CRS,
         )
         bpy.context.view_layer.update()
+        yield COMMITTED  # the old mesh is gone, finish the new one
 
         select_only(self.plane)
         bpy.ops.object.convert(target="MESH")
         # APPLY TRANSFORMS BEFORE UV MAPPING
         bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+        grid = None
+        if key is not None:
+            grid = terrain_grid(bpy.data.objects[self.plane], dem, key)
+        yield
 
         t_obj = bpy.data.objects[self.plane]
         ensure_planar_uv(
@@ -624,6 +1199,7 @@ class Adapt:
             t_obj.data.uv_layers["TL_UV"].active_render = True
         except Exception:
             pass
+        yield
 
         # t_obj = bpy.data.objects["terrain"]
         # uv_name = ensure_planar_uv(t_obj, "TL_UV", flip_v=True)
@@ -632,10 +1208,15 @@ class Adapt:
         self.dimensions = bpy.data.objects["terrain"].dimensions
         assign_material(self.plane, material_name="terrain_material")
         addSide(self.plane, "terrain_sides_material")
-        try:
-            os.remove(path)
-        except OSError:
-            pass
+        if grid is not None:
+            materials = bpy.data.objects[self.plane].data.materials
+            grid["materials"] = (
+                materials.find("terrain_material"),
+                materials.find("terrain_sides_material"),
+            )
+        self.terrain_grid = grid
+        _remove_unchanged(path, stamp)
+        yield
         if adjust_view:
             t = bpy.data.objects.get(self.plane)
             adjust3Dview(t)
@@ -658,9 +1239,14 @@ class Adapt:
         os.remove(path)
 
     def camera_view(self, path, CRS):
+        run_steps(self.view_steps(path, CRS))
+
+    def view_steps(self, path, CRS):
         # re-import vantage line
+        stamp = _stamp(path)
         remove_object(self.view)
         bpy.ops.importgis.shapefile(filepath=path, shpCRS=CRS)
+        yield
         van_line = bpy.data.objects.get(self.view)
         van_line.hide_set(True)
         if not van_line:
@@ -696,13 +1282,33 @@ class Adapt:
             eval_obj.to_mesh_clear()
 
         toggle_camera(dynamic_cam)
+        _remove_unchanged(path, stamp)
+
+    def scan(self, watchFolder):
+        """Apply the newest complete scan manifest, skipping older ones."""
+        run_steps(self.scan_steps(watchFolder))
 
+    def scan_steps(self, watchFolder):
+        folder, manifest = latest_scan(watchFolder, self.last_scan)
+        if folder is None:
+            return
+        self.last_scan = manifest["seq"]
         try:
-            os.remove(path)
-        except OSError:
-            pass
+            patch_files = [
+                name
+                for name in manifest["artifacts"]
+                if name.startswith("patch_") and name.endswith(".png")
+            ]
+            if patch_files:
+                yield from self.tree_steps(patch_files, folder, mark_done=False)
+        finally:
+            # images are packed or split by now, the scan is consumed
+            shutil.rmtree(folder, ignore_errors=True)
 
-    def trees(self, patch_files, watchFolder, use_subtract=True):
+    def trees(self, patch_files, watchFolder, use_subtract=True, mark_done=True):
+        run_steps(self.tree_steps(patch_files, watchFolder, use_subtract, mark_done))
+
+    def tree_steps(self, patch_files, watchFolder, use_subtract=True, mark_done=True):
         # Emitter
         try:
             terrain = bpy.data.objects[self.plane]
@@ -739,20 +1345,34 @@ class Adapt:
         for m in [m for m in terrain.modifiers if m.type == "PARTICLE_SYSTEM"]:
             terrain.modifiers.remove(m)
 
-        planted = []
-        for patch_file in files:
-            # skip non-PNGs or sidecars just in case
-            if not patch_file.lower().endswith(".png"):
-                continue
+        # one packed image carries every class; else one PNG per class
+        entries = []
+        if packedPatchFile in files:
+            try:
+                masks = load_packed_masks(os.path.join(watchFolder, packedPatchFile))
+            except (KeyError, ValueError, RuntimeError) as e:
+                print(f"[trees] skip '{packedPatchFile}' ({e})")
+                masks = {}
+            entries = [(packedPatchFile, cls, img) for cls, img in masks.items()]
+            files = [packedPatchFile]
+        else:
+            for patch_file in files:
+                base = os.path.splitext(patch_file)[0]
+                parts = base.split("_", 1)
+                if len(parts) < 2:
+                    print(f"[trees] skip '{patch_file}' (bad name)")
+                    continue
+                entries.append((patch_file, parts[1], None))  # e.g. 'class1'
 
+        planted = []
+        for patch_file, cls, packed_img in entries:
+            yield  # one class per step
+            # a terrain update runs first and may have replaced the mesh
+            terrain = bpy.data.objects.get(self.plane)
+            if terrain is None:
+                print(f"[trees] terrain '{self.plane}' went away")
+                return
             path = os.path.join(watchFolder, patch_file)
-            base = os.path.splitext(patch_file)[0]
-            parts = base.split("_", 1)
-            if len(parts) < 2:
-                print(f"[trees] skip '{patch_file}' (bad name)")
-                continue
-
-            cls = parts[1]  # e.g. 'class1'
             has_uv = (
                 getattr(terrain.data, "uv_layers", None)
                 and terrain.data.uv_layers.get(uv_name) is not None
@@ -843,22 +1463,26 @@ class Adapt:
             # -----------------------------
             # Load image into the texture (fresh each time; no cache)
             # -----------------------------
-            # Remove any image that points to this filepath OR has the same name
-            for im in list(bpy.data.images):
-                try:
-                    if im.name == patch_file or bpy.path.abspath(
-                        im.filepath
-                    ) == bpy.path.abspath(path):
-                        bpy.data.images.remove(im, do_unlink=True)
-                except Exception:
-                    pass
+            if packed_img is None:
+                # Remove any image that points to this filepath OR has the same name
+                for im in list(bpy.data.images):
+                    try:
+                        if im.name == patch_file or bpy.path.abspath(
+                            im.filepath
+                        ) == bpy.path.abspath(path):
+                            bpy.data.images.remove(im, do_unlink=True)
+                    except Exception:
+                        pass
 
             # strict data behavior
             tex.extension = "CLIP"
             tex.use_interpolation = False
 
-            img = bpy.data.images.load(path, check_existing=False)
-            img.colorspace_settings.name = "Non-Color"  # treat as a mask
+            if packed_img is None:
+                img = bpy.data.images.load(path, check_existing=False)
+                img.colorspace_settings.name = "Non-Color"  # treat as a mask
+            else:
+                img = packed_img  # already split from the packed file
             tex.image = img
 
             slot.blend_type = "SUBTRACT"
@@ -874,10 +1498,11 @@ class Adapt:
             ramp.elements[1].color = (1, 1, 1, 1)
 
             # Pack AFTER assigning, so the texture survives file moves/overwrites
-            try:
-                img.pack()
-            except Exception:
-                pass
+            if packed_img is None:
+                try:
+                    img.pack()
+                except Exception:
+                    pass
 
             # -----------------------------
             # Add particle system on emitter & assign settings
@@ -903,17 +1528,15 @@ class Adapt:
             # except OSError:
             #     pass
 
-            try:
-                base_noext = os.path.splitext(os.path.basename(path))[0]
-                done_path = os.path.join(watchFolder, base_noext + ".done")
-                if os.path.exists(done_path):
-                    os.remove(done_path)
-                os.replace(path, done_path)
-            except Exception:
-                pass
+            if packed_img is None and mark_done:
+                _mark_done(path, watchFolder)
 
             planted.append(cls)
 
+        if packedPatchFile in files and mark_done:
+            # split once, whatever happened to the single classes
+            _mark_done(os.path.join(watchFolder, packedPatchFile), watchFolder)
+
         print(
             f"[trees] planted: {', '.join(sorted(set(planted))) if planted else 'none'}"
         )
@@ -929,42 +1552,70 @@ class ModalTimerOperator(bpy.types.Operator):
 
     def modal(self, context, event):
         if event.type in {"RIGHTMOUSE", "ESC"}:
+            self.watcher.stop()
+            self.work.clear()
             return {"CANCELLED"}
 
         # this condition encomasses all the actions required for watching
         # the folder and related file/object operations .
 
         if event.type == "TIMER":
-
-            if self._timer.time_duration != self._timer_count:
-                self._timer_count = self._timer.time_duration
-                fileList = os.listdir(self.prefs.watchFolder)
-                try:
-                    if terrainFile in fileList:
-                        self.adapt.terrainChange(
-                            self.prefs.terrainPath,
-                            self.prefs.terrain_texture_path,
-                            self.prefs.CRS,
-                        )
-                        print(self._timer_count)
-                    # if waterFile in fileList:
-                    #     self.adapt.waterFill(self.prefs.water_path, self.prefs.CRS)
-                    if viewFile in fileList:
-                        self.adapt.camera_view(self.prefs.view_path, self.prefs.CRS)
-
-                    # if trailFile in fileList:
-                    #     self.adapt.trails(self.prefs.trail_path, self.prefs.CRS)
-                    patch_files = []
-                    for f in fileList:
-                        if f.startswith("patch_") and f.endswith(".png"):
-                            patch_files.append(f)
-                    if patch_files:
-                        self.adapt.trees(patch_files, self.prefs.watchFolder)
-                except RuntimeError:
-                    pass
+            now = self._timer.time_duration
+            # the watcher queue is cheap to drain; listing the folder waits
+            if now != self._timer_count and (
+                self.watcher.live or now - self._timer_count >= self.prefs.timer
+            ):
+                self._timer_count = now
+                self._submit(self.watcher.changes())
+            self._submit_patches()
+            self.work.step()
 
         return {"PASS_THROUGH"}
 
+    def _submit(self, fileList):
+        """Queue the Adapt updates for the changed files."""
+        folder = self.prefs.watchFolder
+        if terrainFile in fileList:
+            self.work.submit(
+                "terrain",
+                _stamp(self.prefs.terrainPath),
+                self.adapt.terrain_steps(
+                    self.prefs.terrainPath,
+                    self.prefs.terrain_texture_path,
+                    self.prefs.CRS,
+                ),
+            )
+        # if waterFile in fileList:
+        #     self.adapt.waterFill(self.prefs.water_path, self.prefs.CRS)
+        if viewFile in fileList:
+            self.work.submit(
+                "view",
+                _stamp(self.prefs.view_path),
+                self.adapt.view_steps(self.prefs.view_path, self.prefs.CRS),
+            )
+
+        # if trailFile in fileList:
+        #     self.adapt.trails(self.prefs.trail_path, self.prefs.CRS)
+        self.patches.add(
+            folder,
+            [f for f in fileList if f.startswith("patch_") and f.endswith(".png")],
+            timer(),
+        )
+        # masks handed off as one versioned scan directory
+        scans = [f for f in fileList if f.startswith(scanPrefix)]
+        if scans:
+            self.work.submit("trees", max(scans), self.adapt.scan_steps(folder))
+
+    def _submit_patches(self):
+        """Queue the trees for the loose patch masks once they stopped coming."""
+        files = self.patches.take(timer())
+        if files:
+            self.work.submit(
+                "trees",
+                tuple(sorted(files.items())),
+                self.adapt.tree_steps(sorted(files), self.prefs.watchFolder),
+            )
+
     def execute(self, context):
         wm = context.window_manager
         wm.modal_handler_add(self)
@@ -975,16 +1626,20 @@ class ModalTimerOperator(bpy.types.Operator):
         self.prefs = Prefs()
         self.adapt = Adapt()
         self.adapt.realism = "High"
-        for file in os.listdir(self.prefs.watchFolder):
-            try:
-                os.remove(os.path.join(self.prefs.watchFolder, file))
-            except:
-                print("Could not remove file")
-        self._timer = wm.event_timer_add(self.prefs.timer, window=context.window)
+        # a scan left from the last session must not be applied on start
+        clear_folder(self.prefs.watchFolder)
+        self.watcher = FolderWatcher(self.prefs.watchFolder)
+        self.work = WorkScheduler(self.prefs.budget)
+        self.patches = FileBatch(self.prefs.patch_quiet)
+        # tick often so queued work runs in small slices between frames
+        interval = min(self.prefs.timer, 0.05)
+        self._timer = wm.event_timer_add(interval, window=context.window)
 
         return {"RUNNING_MODAL"}
 
     def cancel(self, context):
+        self.watcher.stop()
+        self.work.clear()
         wm = context.window_manager
         wm.event_timer_remove(self._timer)
 
@@ -1076,11 +1731,7 @@ class TL_OT_Assets(bpy.types.Operator):
         self.terrain = bpy.data.objects.get("terrain")
 
         # cleanup the watch folder
-        for file in os.listdir(self.prefs.watchFolder):
-            try:
-                os.remove(os.path.join(self.prefs.watchFolder, file))
-            except Exception:
-                print("Could not remove file:", file)
+        clear_folder(self.prefs.watchFolder)
 
         # cleanup old images / modifiers / textures safely
         for img in list(bpy.data.images):
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark run_patches without GRASS, a scanner or Blender.
+
+An in-memory stand-in for grass.script (run_command, mapcalc,
+parse_command, read_command, ...), analyses.classify_colors and the TL
+event handler is installed before patches is imported. run_patches is
+then run over synthetic patch rasters of increasing size and class count
+and the per-stage timings of its profiler are reported.
+
+    python bench_patches.py --sizes 250 500 1000 --classes 4 8 --repeat 5
+
+GRASS module calls are not executed; --spawn-ms adds a fixed delay per
+call to model the cost of starting a module process.
+
+With --labeling-workers, the landscape indices alone are timed instead:
+the single-process numpy engine against the pool engine with each of
+the given worker counts.
+
+    python bench_patches.py --sizes 2000 4000 --labeling-workers 1 2 4 8
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import types
+from statistics import median
+
+import numpy as np
+
+STAGES = [
+    "classify",
+    "vectorize",
+    "indices",
+    "remediation",
+    "dashboard",
+    "styling",
+    "masks",
+    "export",
+]
+
+
+# --- fake GRASS backend ---------------------------------------------------
+
+
+class CalledModuleError(Exception):
+    pass
+
+
+class FakeGrass:
+    """Rasters live in a dict of float arrays with NaN for null."""
+
+    def __init__(self, rows, cols, res=1.0, spawn_ms=0.0):
+        self.rows, self.cols, self.res = rows, cols, res
+        self.spawn = spawn_ms / 1000.0
+        self.rasters = {}
+        self.groups = {}
+        self.calls = {}
+        self.workdir = tempfile.mkdtemp(prefix="bench_patches_")
+        # a location on disk: cell files, WIND and GISRC as GRASS has them
+        self.mapset = os.path.join(self.workdir, "grassdata", "bench", "user")
+        os.makedirs(os.path.join(self.mapset, "cell"))
+        with open(os.path.join(self.mapset, "WIND"), "w") as f:
+            for key, value in (
+                ("proj", 99),
+                ("zone", 0),
+                ("north", rows * res),
+                ("south", 0.0),
+                ("east", cols * res),
+                ("west", 0.0),
+                ("cols", cols),
+                ("rows", rows),
+                ("e-w resol", res),
+                ("n-s resol", res),
+            ):
+                f.write(f"{key}: {value}\n")
+        self.gisrc = os.path.join(self.workdir, "gisrc")
+        with open(self.gisrc, "w") as f:
+            f.write(
+                "GISDBASE: {}\nLOCATION_NAME: bench\nMAPSET: user\n".format(
+                    os.path.join(self.workdir, "grassdata")
+                )
+            )
+
+    # bookkeeping
+
+    def _call(self, module):
+        self.calls[module] = self.calls.get(module, 0) + 1
+        if self.spawn:
+            time.sleep(self.spawn)
+
+    def put(self, name, values):
+        self.rasters[name] = np.asarray(values, dtype=np.float64)
+        # a cell file whose mtime tracks the raster version
+        with open(os.path.join(self.mapset, "cell", name), "w") as f:
+            f.write(str(time.time_ns()))
+
+    def region(self, **kwargs):
+        return {
+            "n": self.rows * self.res,
+            "s": 0.0,
+            "e": self.cols * self.res,
+            "w": 0.0,
+            "nsres": self.res,
+            "ewres": self.res,
+            "rows": self.rows,
+            "cols": self.cols,
+        }
+
+    # grass.script
+
+    def run_command(self, module, **kwargs):
+        self._call(module)
+        if module == "g.copy" and "raster" in kwargs:
+            src, dst = kwargs["raster"]
+            self.put(dst, self.rasters[src].copy())
+        elif module == "g.remove":
+            for name in str(kwargs.get("name", "")).split(","):
+                self.rasters.pop(name, None)
+        elif module == "r.grow":
+            present = ~np.isnan(self.rasters[kwargs["input"]])
+            grown = present.copy()
+            radius = int(kwargs.get("radius", 1) / self.res)
+            for dy in range(-radius, radius + 1):
+                for dx in range(-radius, radius + 1):
+                    if dx * dx + dy * dy <= radius * radius:
+                        grown |= np.roll(np.roll(present, dy, 0), dx, 1)
+            self.put(kwargs["output"], np.where(grown, 1.0, np.nan))
+        elif module.startswith("r.li."):
+            raise CalledModuleError(module)  # no r.li here
+        elif module == "g.mapsets":
+            # the search path of the mapset in the GISRC of env
+            with open(kwargs["env"]["GISRC"]) as f:
+                mapset = dict(line.split(": ", 1) for line in f)["MAPSET"].strip()
+            path = os.path.join(os.path.dirname(self.mapset), mapset, "SEARCH_PATH")
+            with open(path, "w") as f:
+                f.write("\n".join(kwargs["mapset"]) + "\n")
+        elif module == "r.out.gdal":
+            with open(kwargs["output"], "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n")
+        # r.to.vect, v.generalize, v.colors, g.region, r.mask, r.colors, ...
+        # have no effect on the rasters the workflow reads back
+        return 0
+
+    def write_command(self, module, stdin=None, **kwargs):
+        return self.run_command(module, **kwargs)
+
+    def read_command(self, module, **kwargs):
+        self._call(module)
+        if module == "i.group":
+            return "\n".join(self.groups[kwargs["group"]]) + "\n"
+        if module == "r.describe":
+            values = self.rasters[kwargs["map"]]
+            cats = np.unique(values[~np.isnan(values)]).astype(int)
+            return "\n".join(str(c) for c in cats)
+        return ""
+
+    def parse_command(self, module, **kwargs):
+        self._call(module)
+        if module == "r.univar":
+            values = self.rasters[kwargs["map"]]
+            return {"n": str(np.count_nonzero(~np.isnan(values)))}
+        return {}
+
+    def mapcalc(self, exp, **kwargs):
+        self._call("r.mapcalc")
+        name, expression = exp.split("=", 1)
+        self.put(name.strip(), MapcalcParser(expression, self.rasters).parse())
+
+    def find_file(self, name, element="cell", **kwargs):
+        if name in self.rasters:
+            return {"name": name, "file": os.path.join(self.mapset, "cell", name)}
+        return {"name": "", "file": ""}
+
+    def gisenv(self, **kwargs):
+        return {
+            "GISDBASE": os.path.join(self.workdir, "grassdata"),
+            "LOCATION_NAME": "bench",
+            "MAPSET": "user",
+        }
+
+    def region_env(self, **kwargs):
+        return "rows:{};cols:{}".format(self.rows, self.cols)
+
+    def version(self):
+        return {"version": "8.4.0"}
+
+    def warning(self, msg):
+        print("WARNING:", msg, file=sys.stderr)
+
+    def start_command(self, *args, **kwargs):
+        return None
+
+    # grass.script.array
+
+    def array(self, mapname=None, null=None, dtype=np.double, env=None):
+        if mapname is None:
+            out = np.zeros((self.rows, self.cols), dtype=dtype).view(FakeArray)
+            out.grass = self
+            return out
+        values = self.rasters[mapname]
+        null = np.nan if null in (None, "nan") else float(null)
+        return np.where(np.isnan(values), null, values).astype(dtype)
+
+
+class FakeArray(np.ndarray):
+    """grass.script.array.array that writes back into the fake."""
+
+    def write(self, mapname, null=None, overwrite=False, **kwargs):
+        self.grass._call("r.in.bin")
+        values = np.asarray(self, dtype=np.float64)
+        if null is not None:
+            values = np.where(values == float(null), np.nan, values)
+        self.grass.put(mapname, values)
+
+
+class MapcalcParser:
+    """Tiny r.mapcalc subset: numbers, maps, if/int/isnull/null, operators."""
+
+    TOKENS = re.compile(r"\s*(\d+\.?\d*|[A-Za-z_][\w@.]*|==|!=|<=|>=|&&|\|\||.)")
+    BINARY = [("||",), ("&&",), ("==", "!="), ("<", ">", "<=", ">="), ("+", "-")]
+
+    def __init__(self, text, rasters):
+        self.tokens = [t for t in self.TOKENS.findall(text) if t.strip()]
+        self.pos = 0
+        self.rasters = rasters
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.tokens[self.pos]
+        if expected and token != expected:
+            raise ValueError(f"expected {expected}, got {token}")
+        self.pos += 1
+        return token
+
+    def parse(self):
+        return np.asarray(self.binary(0), dtype=np.float64)
+
+    def binary(self, level):
+        if level == len(self.BINARY):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.peek() in self.BINARY[level]:
+            op = self.take()
+            right = self.binary(level + 1)
+            left = self.apply(op, left, right)
+        return left
+
+    @staticmethod
+    def apply(op, a, b):
+        a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+        null = np.isnan(a) | np.isnan(b)
+        with np.errstate(invalid="ignore"):
+            result = {
+                "||": lambda: (a != 0) | (b != 0),
+                "&&": lambda: (a != 0) & (b != 0),
+                "==": lambda: a == b,
+                "!=": lambda: a != b,
+                "<": lambda: a < b,
+                ">": lambda: a > b,
+                "<=": lambda: a <= b,
+                ">=": lambda: a >= b,
+                "+": lambda: a + b,
+                "-": lambda: a - b,
+            }[op]()
+        return np.where(null, np.nan, result.astype(float))
+
+    def unary(self):
+        token = self.take()
+        if token == "(":
+            value = self.binary(0)
+            self.take(")")
+            return value
+        if token == "-":
+            return -self.unary()
+        if token[0].isdigit():
+            return float(token)
+        if self.peek() == "(":
+            self.take("(")
+            args = []
+            while self.peek() != ")":
+                args.append(self.binary(0))
+                if self.peek() == ",":
+                    self.take(",")
+            self.take(")")
+            return self.call(token, args)
+        return self.rasters[token]
+
+    @staticmethod
+    def call(name, args):
+        if name == "null":
+            return np.nan
+        if name == "isnull":
+            return np.isnan(args[0]).astype(float)
+        if name == "int":
+            return np.trunc(args[0])
+        if name == "if":
+            cond, yes, no = (np.asarray(a, dtype=float) for a in args)
+            with np.errstate(invalid="ignore"):
+                result = np.where(cond != 0, yes, no)
+            return np.where(np.isnan(cond), np.nan, result)
+        raise ValueError(f"unsupported function {name}")
+
+
+# --- synthetic scans ------------------------------------------------------
+
+
+def synthetic_patches(rows, cols, classes, seed=0):
+    """Blocky cloth patches: a coarse random class grid scaled up with noise."""
+    rng = np.random.default_rng(seed)
+    block = max(rows // 12, 2)
+    coarse = rng.integers(1, classes + 1, size=(rows // block + 1, cols // block + 1))
+    cats = np.kron(coarse, np.ones((block, block)))[:rows, :cols]
+    noise = rng.random((rows, cols)) < 0.02
+    cats[noise] = rng.integers(1, classes + 1, size=np.count_nonzero(noise))
+    cats[rng.random((rows, cols)) < 0.01] = 7  # mixed class, ignored
+    return cats
+
+
+def install(fake, classes):
+    """Register the fake modules and import patches against them."""
+    grass = types.ModuleType("grass")
+    script = types.ModuleType("grass.script")
+    core = types.ModuleType("grass.script.core")
+    array = types.ModuleType("grass.script.array")
+    exceptions = types.ModuleType("grass.exceptions")
+    jupyter = types.ModuleType("grass.jupyter")
+    for name in (
+        "run_command",
+        "write_command",
+        "read_command",
+        "parse_command",
+        "mapcalc",
+        "find_file",
+        "region",
+        "gisenv",
+        "region_env",
+        "version",
+        "warning",
+    ):
+        setattr(script, name, getattr(fake, name))
+    core.start_command = fake.start_command
+    array.array = fake.array
+    exceptions.CalledModuleError = CalledModuleError
+    grass.script, grass.exceptions, grass.jupyter = script, exceptions, jupyter
+    script.core, script.array = core, array
+
+    analyses = types.ModuleType("analyses")
+
+    def classify_colors(new, group, **kwargs):
+        fake._call("i.segment")
+        fake.put(new, fake.scene)
+
+    analyses.classify_colors = classify_colors
+    activities = types.ModuleType("activities")
+    activities.updateDisplay = lambda value: {"value": value}
+    blender = types.ModuleType("blender")
+    blender.blender_export_PNG = blender.blender_send_file = None
+    tangible_utils = types.ModuleType("tangible_utils")
+    tangible_utils.get_environment = None
+
+    sys.modules.update(
+        {
+            "grass": grass,
+            "grass.script": script,
+            "grass.script.core": core,
+            "grass.script.array": array,
+            "grass.exceptions": exceptions,
+            "grass.jupyter": jupyter,
+            "analyses": analyses,
+            "activities": activities,
+            "blender": blender,
+            "tangible_utils": tangible_utils,
+        }
+    )
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.modules.pop("patches", None)
+    import patches
+
+    patches.trees.update({c: f"class{c}" for c in range(1, classes + 1) if c != 7})
+    # the fakes only exist in this process, which runs no other threads
+    patches.StepPool.start_method = "fork"
+    return patches
+
+
+class EventHandler:
+    activities_panel = None
+
+    def __init__(self):
+        self.events = []
+
+    def postEvent(self, receiver, event):
+        self.events.append(event)
+
+
+# --- benchmark ------------------------------------------------------------
+
+
+def bench(size, classes, repeat, spawn_ms, options):
+    fake = FakeGrass(size, size, spawn_ms=spawn_ms)
+    patches = install(fake, classes)
+    rng = np.random.default_rng(1)
+    fake.put("scanned_elev", rng.random((size, size)) * 100)
+    for band in "rgb":
+        fake.put(f"scan_{band}", rng.integers(0, 256, (size, size)))
+    fake.groups["scan"] = ["scan_r", "scan_g", "scan_b"]
+    water = np.full((size, size), np.nan)
+    water[size // 3 : size // 3 + 3, :] = 1.0
+    fake.put("waterall", water)
+    fake.put("topo_saved", np.zeros((size, size)))
+    training = synthetic_patches(size, size, classes, seed=99)
+    fake.put("training_areas", np.where(training == 7, np.nan, training))
+
+    log = os.path.join(fake.workdir, "profile.jsonl")
+    kwargs = dict(
+        scan_cache=False,
+        async_export=False,
+        profile=True,
+        profile_log=log,
+    )
+    kwargs.update(options)
+    blender_path = os.path.join(fake.workdir, "blender")
+    for i in range(repeat):
+        fake.scene = synthetic_patches(size, size, classes, seed=i)
+        patches.run_patches(
+            "topo_saved",
+            "scanned_elev",
+            "scan",
+            blender_path,
+            EventHandler(),
+            env={"GISRC": fake.gisrc},
+            **kwargs,
+        )
+    with open(log) as f:
+        records = [json.loads(line) for line in f]
+
+    stages = {}
+    served = 0
+    for record in records:
+        for name, stage in record["stages"].items():
+            stages.setdefault(name, []).append(stage["wall"])
+            served += stage.get("served", 0)
+    return {
+        "size": size,
+        "classes": classes,
+        "total": median(r["total"] for r in records),
+        "stages": {name: median(walls) for name, walls in stages.items()},
+        "calls": sum(fake.calls.values()) / float(repeat),
+        "served": served / float(repeat),
+    }
+
+
+def bench_labeling(size, classes, repeat, workers, tile):
+    """Best-of-repeat times of landscape_indices and pool_landscape_indices."""
+    patches = install(FakeGrass(size, size), classes)
+    cats = synthetic_patches(size, size, classes, seed=0).astype(np.int32)
+
+    def best(func, *args):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func(cats, 1.0, *args)
+            times.append(time.perf_counter() - started)
+        return min(times)
+
+    single = best(patches.landscape_indices)
+    rows = []
+    for n in workers:
+        patches.pool_landscape_indices(cats, 1.0, n, tile)  # start the pool
+        elapsed = best(patches.pool_landscape_indices, n, tile)
+        rows.append({"size": size, "workers": n, "time": elapsed, "single": single})
+    return rows
+
+
+def report_labeling(results):
+    header = ["size", "workers", "single", "pool", "speedup"]
+    print(" ".join(f"{h:>11}" for h in header))
+    for r in results:
+        print(
+            f"{r['size']:>11} {r['workers']:>11} {1000 * r['single']:>9.1f}ms "
+            f"{1000 * r['time']:>9.1f}ms {r['single'] / r['time']:>10.2f}x"
+        )
+
+
+def report(results):
+    names = [s for s in STAGES if any(s in r["stages"] for r in results)]
+    header = ["size", "classes"] + names + ["total", "calls", "served"]
+    print(" ".join(f"{h:>11}" for h in header))
+    for r in results:
+        row = [f"{r['size']:>11}", f"{r['classes']:>11}"]
+        row += [f"{1000 * r['stages'].get(n, 0.0):>9.1f}ms" for n in names]
+        row += [f"{1000 * r['total']:>9.1f}ms", f"{r['calls']:>11.0f}"]
+        row += [f"{r['served']:>11.0f}"]
+        print(" ".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000])
+    parser.add_argument("--classes", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--spawn-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--option",
+        action="append",
+        default=[],
+        metavar="KEY=JSON",
+        help="extra run_patches kwarg, e.g. indices_engine='\"rli\"'",
+    )
+    parser.add_argument(
+        "--labeling-workers",
+        type=int,
+        nargs="+",
+        metavar="N",
+        help="time the indices only, on pools of N workers",
+    )
+    parser.add_argument("--tile", type=int, default=256, help="pool tile size")
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+
+    if args.labeling_workers:
+        results = [
+            row
+            for size in args.sizes
+            for row in bench_labeling(
+                size, args.classes[0], args.repeat, args.labeling_workers, args.tile
+            )
+        ]
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            report_labeling(results)
+        return
+
+    options = {}
+    for option in args.option:
+        key, value = option.split("=", 1)
+        options[key] = json.loads(value)
+
+    results = [
+        bench(size, classes, args.repeat, args.spawn_ms, options)
+        for size in args.sizes
+        for classes in args.classes
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,14 +12,43 @@ from tangible_utils import get_environment  # (unused here, but harmless)
 from blender import blender_export_PNG, blender_send_file
 from activities import updateDisplay
 import grass.script as gscript
+import grass.script.core as gcore
+import grass.script.array as garray
 from grass.exceptions import CalledModuleError
 from pathlib import Path
-import grass.jupyter as gj
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import atexit
+import hashlib
+import itertools
+import json
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import threading
+import time
 import shutil
+import struct
+import sys
+import tempfile
+import zlib
+import numpy as np
+
+try:
+    from scipy import ndimage, sparse
+    from scipy.sparse import csgraph
+except ImportError:  # no scipy: fall back to the r.li and r.grow modules
+    ndimage = csgraph = None
 
 trees = {1: "class1", 2: "class2", 3: "class3", 4: "class4"}
 
+RLI_INDICES = ["patchnum", "richness", "mps", "shannon", "shape"]
+REMEDIATION_CAT = 5
+REMEDIATION_RADIUS = 30  # map units, as r.grow -m
+NULL_CAT = -1  # stands in for null cells in category arrays
+
 # --- helpers --------------------------------------------------------------
 
 
@@ -34,34 +63,423 @@ def _raster_exists(name, env):
     return bool(gscript.find_file(name=name, element="cell", env=env).get("name"))
 
 
-# --- main workflow --------------------------------------------------------
+def _group_maps(group, env):
+    maps = gscript.read_command("i.group", flags="g", group=group, env=env)
+    return [m for m in maps.split() if m]
 
 
-def run_patches(
-    real_elev, scanned_elev, scanned_color, blender_path, eventHandler, env, **kwargs
+def _read_cats(name, env):
+    """Read a CELL raster in the current region, nulls as NULL_CAT."""
+    return np.array(garray.array(mapname=name, null=NULL_CAT, dtype=np.int32, env=env))
+
+
+def _read_values(name, env):
+    """Read a raster in the current region as float, nulls as NaN."""
+    return np.array(garray.array(mapname=name, null="nan", env=env))
+
+
+def _raster_stamp(name, env, find_file=None):
+    """Identify the current version of a raster by its cell file mtime."""
+    find_file = find_file or gscript.find_file
+    path = find_file(name=name, element="cell", env=env).get("file")
+    if not path:
+        return None
+    return (path, os.stat(path).st_mtime_ns)
+
+
+def _region_key(region):
+    return tuple(region[k] for k in ("n", "s", "e", "w", "nsres", "ewres"))
+
+
+# --- color classification ------------------------------------------------
+
+
+class ColorClassifier:
+    """Nearest-centroid classifier for the scanned cloth colors.
+
+    Class signatures are the mean colors of the training_areas classes in
+    a calibration scan. They are turned once into a lookup table over
+    colors quantized to bits per channel, so classifying a scan is a
+    single table lookup per pixel.
+    """
+
+    def __init__(self, classes, centroids, bits=5):
+        self.classes = np.asarray(classes, dtype=np.int32)
+        self.centroids = np.asarray(centroids, dtype=np.float64)
+        self.bits = bits
+        levels = 1 << bits
+        step = 256.0 / levels
+        axis = (np.arange(levels) + 0.5) * step  # color at each bin center
+        grid = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1)
+        grid = grid.reshape(-1, 1, 3)
+        distance = ((grid - self.centroids[np.newaxis, :, :]) ** 2).sum(axis=-1)
+        self.lut = self.classes[distance.argmin(axis=1)]
+
+    @classmethod
+    def from_training(cls, training, group, env, bits=5):
+        cats = _read_cats(training, env).ravel()
+        valid = cats != NULL_CAT
+        classes, inverse = np.unique(cats[valid], return_inverse=True)
+        if not classes.size:
+            raise ValueError(f"No training cells in <{training}>")
+        counts = np.bincount(inverse, minlength=classes.size)
+        centroids = np.zeros((classes.size, 3))
+        for band, name in enumerate(_group_maps(group, env)[:3]):
+            values = _read_values(name, env).ravel()[valid]
+            centroids[:, band] = np.bincount(inverse, values, classes.size) / counts
+        return cls(classes, centroids, bits)
+
+    def classify(self, bands, minsize=0):
+        """Classify (r, g, b) arrays; patches under minsize cells become null."""
+        shift = 8 - self.bits
+        index = np.zeros(bands[0].shape, dtype=np.int64)
+        nodata = np.zeros(bands[0].shape, dtype=bool)
+        for band in bands:
+            nodata |= np.isnan(band)
+            channel = np.clip(np.nan_to_num(band), 0, 255).astype(np.int64) >> shift
+            index = (index << self.bits) | channel
+        cats = self.lut[index]
+        cats[nodata] = NULL_CAT
+        if minsize > 1:
+            # one labeling pass for all classes, then drop the small patches
+            _, labels = _label_patches(cats)
+            valid = labels >= 0
+            sizes = np.bincount(labels[valid])
+            small = np.zeros(labels.shape, dtype=bool)
+            small[valid] = sizes[labels[valid]] < minsize
+            cats[small] = NULL_CAT
+        return cats
+
+
+def _centroid_classify(
+    new,
+    group,
+    env,
+    state,
+    training_group,
+    minsize=10,
+    training="training_areas",
+    find_file=None,
 ):
-    topo = "topo_saved"
-
-    # 1) detect patches (cloth colors -> categories)
-    patches = "patches"
-    analyses.classify_colors(
-        new=patches,
-        group=scanned_color,
-        compactness=2,
-        threshold=0.3,
-        minsize=10,
-        useSuperPixels=True,
-        env=env,
+    """Write the new patches raster with the nearest-centroid classifier.
+
+    Signatures come from the training_group calibration scan, the one the
+    cloths were laid out on for training_areas, and are kept in state until
+    training_areas or that scan changes. A live scan would not do: the
+    cloths may have moved off the training areas by then.
+    """
+    if not training_group:
+        raise ValueError("The centroid classifier needs a training_group")
+    key = (
+        _raster_stamp(training, env, find_file),
+        training_group,
+        tuple(
+            _raster_stamp(name, env, find_file)
+            for name in _group_maps(training_group, env)[:3]
+        ),
     )
-    gscript.run_command(
-        "r.to.vect", flags="svt", input=patches, output=patches, type="area", env=env
+    if state.get("key") != key:
+        state["instance"] = ColorClassifier.from_training(training, training_group, env)
+        state["key"] = key
+    bands = [_read_values(name, env) for name in _group_maps(group, env)[:3]]
+    cats = state["instance"].classify(bands, minsize)
+    out = garray.array(dtype=np.int32, env=env)
+    out[...] = cats
+    out.write(mapname=new, null=NULL_CAT, overwrite=True)
+    gscript.run_command("r.colors", map=new, raster=training, env=env)
+
+
+# --- landscape indices ----------------------------------------------------
+
+
+def _label_patches(cats):
+    """Label 4-connected patches of all classes in one pass.
+
+    Returns (number of patches, labels) where labels is -1 on null cells.
+    Uses the same 4-neighbour rule as the r.li modules.
+    """
+    valid = cats != NULL_CAT
+    nodes = np.full(cats.shape, -1, dtype=np.int64)
+    nodes[valid] = np.arange(np.count_nonzero(valid))
+    right = valid[:, :-1] & (cats[:, :-1] == cats[:, 1:])
+    down = valid[:-1, :] & (cats[:-1, :] == cats[1:, :])
+    src = np.concatenate([nodes[:, :-1][right], nodes[:-1, :][down]])
+    dst = np.concatenate([nodes[:, 1:][right], nodes[1:, :][down]])
+    n = int(nodes.max()) + 1
+    graph = sparse.coo_matrix(
+        (np.ones(src.size, dtype=np.int8), (src, dst)), shape=(n, n)
+    )
+    npatch, component = csgraph.connected_components(graph, directed=False)
+    labels = np.full(cats.shape, -1, dtype=np.int64)
+    labels[valid] = component
+    return npatch, labels
+
+
+def _perimeter_edges(cats):
+    """Count cell edges between a patch cell and another class, null or border."""
+    padded = np.pad(cats, 1, constant_values=NULL_CAT)
+    core = padded[1:-1, 1:-1]
+    valid = core != NULL_CAT
+    edges = 0
+    for nb in (
+        padded[:-2, 1:-1],
+        padded[2:, 1:-1],
+        padded[1:-1, :-2],
+        padded[1:-1, 2:],
+    ):
+        edges += np.count_nonzero(valid & (nb != core))
+    return edges
+
+
+def landscape_indices(cats, cell_area):
+    """Compute the r.li indices (patchnum, richness, mps, shannon, shape).
+
+    cats is a category array with NULL_CAT for nulls, cell_area in map
+    units squared. mps keeps the x10 scaling of the original r.li loop;
+    an array without patch cells gives all zeros.
+    """
+    valid = cats != NULL_CAT
+    ncells = np.count_nonzero(valid)
+    if not ncells:
+        return [0.0 for _ in RLI_INDICES]
+
+    npatch, _ = _label_patches(cats)
+    _, counts = np.unique(cats[valid], return_counts=True)
+    return _indices(npatch, counts, _perimeter_edges(cats), cell_area)
+
+
+def _indices(npatch, counts, edges, cell_area):
+    # counts: cells per class in class order, edges: from _perimeter_edges
+    ncells = counts.sum()
+    p = counts / float(ncells)
+    richness = float(counts.size)
+    shannon = float((p * np.log(1.0 / p)).sum())
+    mps = ncells * cell_area / 10000.0 / npatch  # hectares, as r.li.mps
+    shape = 0.25 * edges / np.sqrt(ncells)
+    return [float(npatch), richness, float(mps * 10), shannon, float(shape)]
+
+
+def _pair_edges(a, b):
+    # perimeter edges between two equally shaped arrays of neighbour cells
+    differ = a != b
+    return np.count_nonzero(differ & (a != NULL_CAT)) + np.count_nonzero(
+        differ & (b != NULL_CAT)
+    )
+
+
+def _tile_window(tile, i, j):
+    return slice(i * tile, (i + 1) * tile), slice(j * tile, (j + 1) * tile)
+
+
+def _tile_stats(block, outer):
+    """Patches, labels, class counts and edges of one tile.
+
+    outer flags the (top, bottom, left, right) sides on the region border;
+    edges across the other sides are counted by _stitch.
+    """
+    valid = block != NULL_CAT
+    if valid.any():
+        npatch, labels = _label_patches(block)
+    else:
+        npatch, labels = 0, np.full(block.shape, -1, dtype=np.int64)
+    values, counts = np.unique(block[valid], return_counts=True)
+    edges = _pair_edges(block[:, :-1], block[:, 1:])
+    edges += _pair_edges(block[:-1, :], block[1:, :])
+    for border, on_border in zip(
+        (valid[0, :], valid[-1, :], valid[:, 0], valid[:, -1]), outer
+    ):
+        if on_border:
+            edges += np.count_nonzero(border)
+    return npatch, labels, dict(zip(values.tolist(), counts.tolist())), edges
+
+
+def _tile_outer(grid, i, j):
+    rows, cols = grid
+    return (i == 0, i == rows - 1, j == 0, j == cols - 1)
+
+
+def _class_totals(tile_counts):
+    # cells per class over all tiles, in class order as np.unique
+    totals = {}
+    for counts in tile_counts:
+        for cat, n in counts.items():
+            totals[cat] = totals.get(cat, 0) + n
+    return np.array([totals[cat] for cat in sorted(totals)], dtype=np.int64)
+
+
+def _stitch(cats, labels, npatch, tile):
+    """Merge per-tile patch labels across the tile seams.
+
+    labels holds tile-local labels, npatch the patch count of each tile.
+    Returns the number of patches of the whole array and the perimeter
+    edges across the seams.
+    """
+    offsets = (np.cumsum(npatch) - npatch.ravel()).reshape(npatch.shape)
+    tile_row = np.arange(cats.shape[0]) // tile
+    tile_col = np.arange(cats.shape[1]) // tile
+    edges = 0
+    src, dst = [], []
+    for c in range(tile, cats.shape[1], tile):
+        a, b = cats[:, c - 1], cats[:, c]
+        edges += _pair_edges(a, b)
+        same = (a == b) & (a != NULL_CAT)
+        src.append((labels[:, c - 1] + offsets[tile_row, (c - 1) // tile])[same])
+        dst.append((labels[:, c] + offsets[tile_row, c // tile])[same])
+    for r in range(tile, cats.shape[0], tile):
+        a, b = cats[r - 1, :], cats[r, :]
+        edges += _pair_edges(a, b)
+        same = (a == b) & (a != NULL_CAT)
+        src.append((labels[r - 1, :] + offsets[(r - 1) // tile, tile_col])[same])
+        dst.append((labels[r, :] + offsets[r // tile, tile_col])[same])
+    n = int(npatch.sum())
+    src = np.concatenate(src) if src else np.zeros(0, dtype=np.int64)
+    dst = np.concatenate(dst) if dst else np.zeros(0, dtype=np.int64)
+    graph = sparse.coo_matrix(
+        (np.ones(src.size, dtype=np.int8), (src, dst)), shape=(n, n)
     )
+    patches, _ = csgraph.connected_components(graph, directed=False)
+    return patches, edges
+
+
+class TiledIndices:
+    """Landscape indices kept up to date tile by tile between scans.
+
+    update() diffs the category array against the previous one in tiles
+    of tile x tile cells and only relabels the tiles that changed. Class
+    counts, perimeter edges and patch labels are kept per tile; patches
+    cut by tile seams are merged again through the connected components
+    of the seam graph, so the result equals landscape_indices on the
+    whole array.
+    """
+
+    def __init__(self, tile=64):
+        self.tile = tile
+        self.relabeled = 0  # tiles relabeled by the last update
+        self._cats = None
+
+    def _start(self, shape):
+        rows, cols = shape
+        self._grid = (-(-rows // self.tile), -(-cols // self.tile))
+        self._labels = np.full(shape, -1, dtype=np.int64)
+        self._npatch = np.zeros(self._grid, dtype=np.int64)
+        self._counts = {}  # (tile row, tile col) -> {class: cells}
+        self._edges = np.zeros(self._grid, dtype=np.int64)
+
+    def _relabel(self, cats, i, j):
+        window = _tile_window(self.tile, i, j)
+        npatch, labels, counts, edges = _tile_stats(
+            cats[window], _tile_outer(self._grid, i, j)
+        )
+        self._labels[window] = labels
+        self._npatch[i, j] = npatch
+        self._counts[i, j] = counts
+        self._edges[i, j] = edges
+
+    def _dirty(self, cats):
+        if self._cats is None or self._cats.shape != cats.shape:
+            self._start(cats.shape)
+            return np.ones(self._grid, dtype=bool)
+        changed = cats != self._cats
+        rows, cols = self._grid
+        padded = np.zeros((rows * self.tile, cols * self.tile), dtype=bool)
+        padded[: cats.shape[0], : cats.shape[1]] = changed
+        return padded.reshape(rows, self.tile, cols, self.tile).any(axis=(1, 3))
+
+    def update(self, cats, cell_area):
+        """Indices of cats as landscape_indices would compute them."""
+        dirty = self._dirty(cats)
+        for i, j in zip(*np.nonzero(dirty)):
+            self._relabel(cats, i, j)
+        self.relabeled = int(np.count_nonzero(dirty))
+        self._cats = cats.copy()
 
-    base_cat = [7]  # categories to ignore (mixed, etc.)
+        counts = _class_totals(self._counts.values())
+        if not counts.size:
+            return [0.0 for _ in RLI_INDICES]
+        npatch, seam_edges = _stitch(cats, self._labels, self._npatch, self.tile)
+        edges = int(self._edges.sum()) + seam_edges
+        return _indices(npatch, counts, edges, cell_area)
 
-    # r.li setup (GRASS 8.x path)
-    indices_prefix = "index_"
-    rliroot = os.path.join(expanduser("~"), f".grass{_grass_major()}", "r.li")
+
+def _attach(name, shape, dtype):
+    # pool workers share the parent's resource tracker, which unlinks
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _label_tiles(cats_name, labels_name, shape, tile, grid, tiles):
+    """Pool step: label some tiles of the shared category array.
+
+    Labels are written into the shared labels array; returns the per-tile
+    (i, j, npatch, counts, edges).
+    """
+    cats_shm, cats = _attach(cats_name, shape, np.int32)
+    labels_shm, labels = _attach(labels_name, shape, np.int64)
+    try:
+        stats = []
+        for i, j in tiles:
+            window = _tile_window(tile, i, j)
+            npatch, labels[window], counts, edges = _tile_stats(
+                cats[window], _tile_outer(grid, i, j)
+            )
+            stats.append((i, j, npatch, counts, edges))
+        return stats
+    finally:
+        del cats, labels
+        cats_shm.close()
+        labels_shm.close()
+
+
+def pool_landscape_indices(cats, cell_area, workers, tile=256, pool=None):
+    """landscape_indices with the patch labeling spread over the process pool.
+
+    cats and the labels are shared with the workers through shared
+    memory; each worker labels a set of tiles and the tile labels are
+    stitched at the seams here. pool is the StepPool to use.
+    """
+    shape = cats.shape
+    grid = (-(-shape[0] // tile), -(-shape[1] // tile))
+    tiles = [(i, j) for i in range(grid[0]) for j in range(grid[1])]
+    cats_shm = shared_memory.SharedMemory(create=True, size=max(cats.size * 4, 1))
+    labels_shm = shared_memory.SharedMemory(create=True, size=max(cats.size * 8, 1))
+    shared = labels = None
+    try:
+        shared = np.ndarray(shape, dtype=np.int32, buffer=cats_shm.buf)
+        shared[...] = cats
+        # a few chunks per worker even out tiles of unequal cost
+        chunks = max(1, min(len(tiles), 4 * workers))
+        steps = {
+            n: (
+                _label_tiles,
+                (cats_shm.name, labels_shm.name, shape, tile, grid, tiles[n::chunks]),
+            )
+            for n in range(chunks)
+        }
+        npatch = np.zeros(grid, dtype=np.int64)
+        tile_counts = []
+        edges = 0
+        for stats in run_steps(steps, workers, pool=pool).values():
+            for i, j, n, counts, tile_edges in stats:
+                npatch[i, j] = n
+                tile_counts.append(counts)
+                edges += tile_edges
+        counts = _class_totals(tile_counts)
+        if not counts.size:
+            return [0.0 for _ in RLI_INDICES]
+        labels = np.ndarray(shape, dtype=np.int64, buffer=labels_shm.buf)
+        patches, seam_edges = _stitch(shared, labels, npatch, tile)
+        return _indices(patches, counts, edges + seam_edges, cell_area)
+    finally:
+        shared = labels = None  # release the buffers before closing
+        cats_shm.close()
+        cats_shm.unlink()
+        labels_shm.close()
+        labels_shm.unlink()
+
+
+def _rli_setup(major, prefix="index_"):
+    # r.li setup (GRASS 8.x path); outputs are named prefix + index
+    rliroot = os.path.join(expanduser("~"), f".grass{major}", "r.li")
     configpath = os.path.join(rliroot, "patches")
     outputpath = os.path.join(rliroot, "output")
     os.makedirs(rliroot, exist_ok=True)
@@ -70,161 +488,578 @@ def run_patches(
         with open(configpath, "w") as f:
             f.write("SAMPLINGFRAME 0|0|1|1\n")
             f.write("SAMPLEAREA 0.0|0.0|1|1\n")
+    return configpath, outputpath, prefix
 
-    # raster without base_cat values
-    gscript.mapcalc(
-        "{p2} = if({p} != {cl1}, int({p}), null())".format(
-            p2=patches + "2", p=patches, cl1=base_cat[0]
-        ),
+
+def _rli_has_cells(raster, env):
+    univar = gscript.parse_command("r.univar", map=raster, flags="g", env=env)
+    return bool(univar and float(univar.get("n", 0)) > 0)
+
+
+def _rli_index(raster, index, env, rli):
+    """Run one r.li module and read its result; raises CalledModuleError.
+
+    rli is the (config, output, prefix) triple from _rli_setup.
+    """
+    configpath, outputpath, indices_prefix = rli
+    gscript.run_command(
+        "r.li." + index,
+        input=raster,
+        output=indices_prefix + index,
+        config=configpath,
         env=env,
     )
-    gscript.run_command("g.region", raster=patches + "2", env=env)
-
-    # 2) landscape indices (robust against empty inputs)
-    results_list = []
-    rliindices = ["patchnum", "richness", "mps", "shannon", "shape"]
+    with open(os.path.join(outputpath, indices_prefix + index), "r") as f:
+        r = f.readlines()[0].strip().split("|")[-1]
+    val = float(r)
+    if index == "mps":
+        val *= 10  # keep original scaling
+    return val
 
-    univar = gscript.parse_command("r.univar", map=patches + "2", flags="g", env=env)
-    has_cells = bool(univar and float(univar.get("n", 0)) > 0)
 
+def _rli_indices(raster, env, rli, has_cells=None):
+    if has_cells is None:
+        has_cells = _rli_has_cells(raster, env)
     if not has_cells:
         # zeros if there are no patch pixels
-        results_list = [0.0 for _ in rliindices]
-    else:
-        for index in rliindices:
-            try:
-                gscript.run_command(
-                    "r.li." + index,
-                    input=patches + "2",
-                    output=indices_prefix + index,
-                    config=configpath,
-                    env=env,
-                )
-                with open(os.path.join(outputpath, indices_prefix + index), "r") as f:
-                    r = f.readlines()[0].strip().split("|")[-1]
-                val = float(r)
-                if index == "mps":
-                    val *= 10  # keep original scaling
-                results_list.append(val)
-            except CalledModuleError:
-                # if any r.li fails, return zeros (but keep pipeline alive)
-                results_list = [0.0 for _ in rliindices]
-                break
+        return [0.0 for _ in RLI_INDICES]
+    try:
+        return [_rli_index(raster, index, env, rli) for index in RLI_INDICES]
+    except CalledModuleError:
+        # if any r.li fails, return zeros (but keep pipeline alive)
+        return [0.0 for _ in RLI_INDICES]
 
-    # 3) remediation percentage (only if waterall exists)
-    if _raster_exists("waterall", env):
-        gscript.run_command(
-            "r.grow",
-            flags="m",
-            input="waterall",
-            output="waterallg",
-            radius=30,
-            new=1,
-            env=env,
-        )
-        gscript.mapcalc(
-            "{new} = if({w} && {p} == 5, 1, null())".format(
-                new="remed", w="waterallg", p=patches + "2"
-            ),
-            env=env,
-        )
-        u = gscript.parse_command("r.univar", map="remed", flags="g", env=env)
-        remed_size = float(u.get("n", 0)) if u else 0.0
-        u = gscript.parse_command("r.univar", map="waterall", flags="g", env=env)
-        waterall_n = float(u.get("n", 0)) if u else 0.0
-        perc = 100.0 * remed_size / waterall_n if waterall_n else 0.0
-    else:
-        perc = 0.0
-    results_list.insert(0, perc)  # prepend remediation %
 
-    # 4) update dashboard (if TL UI is running)
-    event = updateDisplay(value=results_list)
-    eventHandler.postEvent(receiver=eventHandler.activities_panel, event=event)
+# --- remediation ---------------------------------------------------------
 
-    # 5) export patches to Blender
-    gscript.mapcalc("scanned_scan_int = int({})".format(scanned_elev), env=env)
 
-    # vector styling (color rules): prefer your fixed file; else training_areas; else local file
-    patch_rast = patches + "2"  # source raster (same as your patch_vec_src)
-    patch_vec_raw = patches + "2_vec"
-    patch_vec = patches + "2gen"  # smoothed vector you’ll color/display
-    try:
-        # convert & smooth (safe on re-runs)
-        gscript.run_command(
-            "r.to.vect",
-            input=patch_rast,
-            output=patch_vec_raw,
-            type="area",
-            env=env,
-            overwrite=True,
-        )  # <-- no '-t'
+def water_buffer(water, radius, nsres, ewres):
+    """Grow water cells by radius map units like r.grow -m new=1.
 
-        gscript.run_command(
-            "v.generalize",
-            input=patch_vec_raw,
-            type="area",
-            output=patch_vec,
-            method="snakes",
-            threshold=100,
-            env=env,
-            overwrite=True,
+    Returns a boolean array: buffer cells are True, original water cells
+    keep their own truth value.
+    """
+    present = ~np.isnan(water)
+    if not present.any():
+        return present
+    distance = ndimage.distance_transform_edt(~present, sampling=(nsres, ewres))
+    return np.where(present, water != 0, distance <= radius)
+
+
+def _remediation(cats2, region, env, cache, find_file=None):
+    """Percent of water cells that have remediation patches in their buffer.
+
+    The grown water buffer is kept in cache until waterall or the region
+    changes.
+    """
+    stamp = _raster_stamp("waterall", env, find_file)
+    if stamp is None:
+        return 0.0
+    key = stamp + _region_key(region)
+    if cache.get("key") != key:
+        water = _read_values("waterall", env)
+        cache["buffer"] = water_buffer(
+            water, REMEDIATION_RADIUS, region["nsres"], region["ewres"]
         )
+        cache["cells"] = np.count_nonzero(~np.isnan(water))
+        cache["key"] = key
+    waterall_n = cache["cells"]
+    if not waterall_n:
+        return 0.0
+    remed_size = np.count_nonzero(cache["buffer"] & (cats2 == REMEDIATION_CAT))
+    return 100.0 * remed_size / waterall_n
 
-        # color rules (use your file first)
-        rules_path = Path("/home/buas/Documents/TL_Activities/patch_colors.txt")
-        if rules_path.exists():
-            gscript.run_command(
-                "v.colors", map=patch_vec, rules=str(rules_path), env=env
-            )
-        elif _raster_exists("training_areas", env):
-            rules_txt = gscript.read_command(
-                "r.colors.out", map="training_areas", env=env
-            )
-            rules_txt = "\n".join(
-                ln
-                for ln in rules_txt.splitlines()
-                if ln and not ln.startswith(("nv", "default"))
+
+def _grass_remediation(patches2, env):
+    if not _raster_exists("waterall", env):
+        return 0.0
+    gscript.run_command(
+        "r.grow",
+        flags="m",
+        input="waterall",
+        output="waterallg",
+        radius=REMEDIATION_RADIUS,
+        new=1,
+        env=env,
+    )
+    gscript.mapcalc(
+        "{new} = if({w} && {p} == {cat}, 1, null())".format(
+            new="remed", w="waterallg", p=patches2, cat=REMEDIATION_CAT
+        ),
+        env=env,
+    )
+    u = gscript.parse_command("r.univar", map="remed", flags="g", env=env)
+    remed_size = float(u.get("n", 0)) if u else 0.0
+    u = gscript.parse_command("r.univar", map="waterall", flags="g", env=env)
+    waterall_n = float(u.get("n", 0)) if u else 0.0
+    return 100.0 * remed_size / waterall_n if waterall_n else 0.0
+
+
+# --- instrumentation -----------------------------------------------------
+
+
+class ScanProfile:
+    """Wall time, module spawns, calls served in-process and bytes per scan stage."""
+
+    def __init__(self, profiler, scan_id):
+        self.profiler = profiler
+        self.scan_id = scan_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.flags = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        previous = getattr(_active, "stage", None)
+        _active.profile, _active.stage = self, name
+        self._entry(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name]["wall"] += time.perf_counter() - start
+            _active.stage = previous
+            if previous is None:
+                _active.profile = None
+
+    def _entry(self, name):
+        with self._lock:
+            return self.stages.setdefault(
+                name, {"wall": 0.0, "spawned": 0, "served": 0, "bytes": 0}
             )
-            if rules_txt:
-                gscript.write_command(
-                    "v.colors", map=patch_vec, rules="-", stdin=rules_txt, env=env
-                )
-            # 3) fallback: file next to this script
-            else:
-                alt = Path(__file__).with_name("patch_colors.txt")
-                if alt.exists():
-                    gscript.run_command(
-                        "v.colors", map=patch_vec, rules=str(alt), env=env
-                    )
 
-    except CalledModuleError:
-        # styling is optional; keep going even if it fails
+    def _add(self, field, n):
+        name = getattr(_active, "stage", None)
+        if name:
+            entry = self._entry(name)
+            with self._lock:
+                entry[field] += n
+
+    def add_spawn(self):
+        self._add("spawned", 1)
+
+    def add_served(self):
+        self._add("served", 1)
+
+    def add_bytes(self, n):
+        self._add("bytes", n)
+
+    def finish(self, **flags):
+        self.flags.update(flags)
+        self.profiler.emit(self)
+
+
+class _NoProfile:
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def add_bytes(self, n):
         pass
 
-    # clear any MASK (best effort)
-    try:
-        gscript.run_command("r.mask", flags="r", env=env)
-    except Exception:
+    def add_served(self):
+        pass
+
+    def finish(self, **flags):
         pass
 
-    gscript.run_command("g.region", raster=topo, align=topo, env=env)
 
-    # 6) per-class masks for Blender (black=plant, white=don’t)
+_NO_PROFILE = _NoProfile()
+_active = threading.local()
+
+
+def _current_profile():
+    return getattr(_active, "profile", None) or _NO_PROFILE
+
+
+def _counting_start_command(start_command):
+    def wrapper(*args, **kwargs):
+        profile = getattr(_active, "profile", None)
+        if profile is not None and getattr(_active, "stage", None):
+            profile.add_spawn()
+        backend = getattr(_active, "backend", None)
+        if backend is not None:
+            backend.add_spawn(args[0] if args else kwargs.get("prog"))
+        return start_command(*args, **kwargs)
+
+    wrapper.counting = True
+    return wrapper
+
+
+def _count_spawns():
+    """Count GRASS module spawns by wrapping start_command, once."""
+    if not getattr(gcore.start_command, "counting", False):
+        gcore.start_command = _counting_start_command(gcore.start_command)
+
+
+class StageProfiler:
+    """Emit one JSON line per scan with per-stage timings.
+
+    Lines are appended to log (a path) or written to stderr. With summary,
+    each line also carries rolling p50/p95 wall times over window scans.
+    GRASS module spawns are counted by wrapping start_command, which every
+    grass.script call goes through; steps run in the process pool are
+    not included.
+    """
+
+    def __init__(self, log=None, summary=False, window=100):
+        self.log = log
+        self.summary_enabled = summary
+        self.window = window
+        self._history = {}
+        self._lock = threading.Lock()
+        _count_spawns()
+
+    def scan(self, scan_id):
+        return ScanProfile(self, scan_id)
+
+    def summary(self):
+        with self._lock:
+            result = {}
+            for name, walls in self._history.items():
+                ordered = sorted(walls)
+                result[name] = {
+                    "p50": ordered[int(0.5 * (len(ordered) - 1))],
+                    "p95": ordered[int(0.95 * (len(ordered) - 1))],
+                }
+            return result
+
+    def emit(self, profile):
+        total = time.perf_counter() - profile.started
+        record = {
+            "scan": profile.scan_id,
+            "time": time.time(),
+            "total": total,
+            "stages": profile.stages,
+        }
+        record.update(profile.flags)
+        with self._lock:
+            for name, stage in list(profile.stages.items()) + [
+                ("total", {"wall": total})
+            ]:
+                history = self._history.setdefault(name, deque(maxlen=self.window))
+                history.append(stage["wall"])
+        if self.summary_enabled:
+            record["summary"] = self.summary()
+        line = json.dumps(record)
+        with self._lock:
+            if self.log:
+                with open(self.log, "a") as f:
+                    f.write(line + "\n")
+            else:
+                print(line, file=sys.stderr)
+
+
+# --- scan cache ----------------------------------------------------------
+
+
+class ScanCache:
+    """Bounded LRU of pipeline results keyed on the scan content.
+
+    Entries hold the dashboard values and the exported mask files, so an
+    unchanged scan can skip classification, indices and export.
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.last_key = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # the export worker stores entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > max(self.maxsize, 1):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.last_key = None
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# run_patches options that change the exported masks or the styled vector,
+# with their defaults
+SCAN_KEY_OPTIONS = {
+    "mask_export": "bulk",
+    "mask_format": "separate",
+    "use_subtract": True,
+    "mask_factor": None,
+    "mask_res": None,
+    "handoff": "manifest",
+    # the styled vector restored on a hit
+    "smoothing": "snakes",
+    "smoothing_size": 5,
+}
+
+
+def _scan_key(scanned_elev, scanned_color, env, tolerance=0, extra=()):
+    """Hash the scanned elevation and color bands in the current region.
+
+    With a tolerance, values are quantized to steps of that size before
+    hashing, so sensor noise below it maps to the same key. extra, e.g.
+    the waterall version and the export options, is hashed along.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(extra).encode())
+    for name in [scanned_elev] + _group_maps(scanned_color, env):
+        values = _read_values(name, env)
+        if tolerance:
+            values = np.floor(values / tolerance)
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+
+# --- Blender masks -------------------------------------------------------
+
+
+PACKED_MASK = "patch_pack.png"  # all classes of a scan in one image
+PACK_BANDS = "RGBA"
+
+
+def _encode_png(pixels, palette=None, text=None):
+    """Encode a uint8 array as an 8-bit PNG.
+
+    A 2D array is grayscale, or indexed with palette (a list of RGB
+    tuples); a rows x cols x 4 array is RGBA. text becomes tEXt chunks.
+    """
+    height, width = pixels.shape[:2]
+    if pixels.ndim == 3:
+        color_type = 6
+    else:
+        color_type = 0 if palette is None else 3
+    rows = pixels.reshape(height, -1)
+    raw = np.zeros((height, rows.shape[1] + 1), dtype=np.uint8)  # filter byte 0
+    raw[:, 1:] = rows
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    chunks = [b"\x89PNG\r\n\x1a\n", chunk(b"IHDR", header)]
+    if palette is not None:
+        chunks.append(chunk(b"PLTE", bytes(c for rgb in palette for c in rgb)))
+    for key, value in (text or {}).items():
+        chunks.append(chunk(b"tEXt", key.encode("latin-1") + b"\0" + value.encode()))
+    chunks.append(chunk(b"IDAT", zlib.compress(raw.tobytes(), 1)))  # as ZLEVEL=1
+    chunks.append(chunk(b"IEND", b""))
+    return b"".join(chunks)
+
+
+def class_masks(cats, base_cat, use_subtract=True):
+    """Derive one 0/255 mask per tree class present in a category array.
+
+    With use_subtract the class is black (plant) and everything else white,
+    otherwise the other way round. Returns {mask name: uint8 array}.
+    """
+    inside, outside = (0, 255) if use_subtract else (255, 0)
+    masks = {}
+    for cat in np.unique(cats):
+        cat = int(cat)
+        if cat == NULL_CAT or cat in base_cat or cat not in trees:
+            continue
+        masks[f"patch_{trees[cat]}"] = np.where(cats == cat, inside, outside).astype(
+            np.uint8
+        )
+    return masks
+
+
+def _palette_color(index):
+    # 37 is odd, so red alone already tells 256 indices apart
+    return ((37 * index) % 256, (91 * index) % 256, (151 * index) % 256)
+
+
+def packed_masks(cats, base_cat, use_subtract=True):
+    """Pack the masks of all tree classes of a category array into one image.
+
+    Up to four classes get one band of an RGBA image each, holding the
+    class_masks values. With more, the image is indexed: 0 outside any
+    class, otherwise the class's palette entry. Returns (pixels, palette,
+    manifest), palette None for RGBA; the manifest maps bands or palette
+    colors to class names.
+    """
+    present = [
+        int(cat)
+        for cat in np.unique(cats)
+        if cat != NULL_CAT and int(cat) not in base_cat and int(cat) in trees
+    ]
+    manifest = {"use_subtract": use_subtract}
+    if len(present) <= len(PACK_BANDS):
+        inside, outside = (0, 255) if use_subtract else (255, 0)
+        pixels = np.full(cats.shape + (len(PACK_BANDS),), outside, dtype=np.uint8)
+        for band, cat in enumerate(present):
+            pixels[..., band] = np.where(cats == cat, inside, outside)
+        manifest["format"] = "rgba"
+        manifest["bands"] = {PACK_BANDS[b]: trees[c] for b, c in enumerate(present)}
+        return pixels, None, manifest
+    lut = np.zeros(int(cats.max()) + 2, dtype=np.uint8)  # shifted by one for NULL_CAT
+    for index, cat in enumerate(present, start=1):
+        lut[cat + 1] = index
+    palette = [_palette_color(index) for index in range(len(present) + 1)]
+    manifest["format"] = "indexed"
+    manifest["palette"] = {
+        trees[cat]: palette[index] for index, cat in enumerate(present, start=1)
+    }
+    return lut[cats + 1], palette, manifest
+
+
+def mask_shape(shape, nsres, ewres, factor=None, res=None):
+    """Mask size for a downsample factor or a target pixel size res.
+
+    nsres and ewres are the cell sizes of the rows and columns of shape.
+    """
+    factors = (res / nsres, res / ewres) if res else (factor, factor)
+    return tuple(
+        max(1, int(round(n / f))) if f and f > 1 else n for n, f in zip(shape, factors)
+    )
+
+
+def downsample_mode(cats, shape):
+    """Resample a category array to shape by majority over the same extent.
+
+    Each output cell takes an equal share of the input rows and columns,
+    so the extent stays aligned with the terrain even when the factor
+    does not divide the size. Null is counted like any category.
+    """
+    rows, cols = cats.shape
+    if (rows, cols) == tuple(shape):
+        return cats
+    out_rows, out_cols = shape
+    row_idx = np.arange(rows) * out_rows // rows
+    col_idx = np.arange(cols) * out_cols // cols
+    values, codes = np.unique(cats, return_inverse=True)
+    cell = row_idx[:, None] * out_cols + col_idx[None, :]
+    counts = np.bincount(
+        (cell * len(values) + codes.reshape(cats.shape)).ravel(),
+        minlength=out_rows * out_cols * len(values),
+    )
+    mode = counts.reshape(-1, len(values)).argmax(axis=1)
+    return values[mode].reshape(shape).astype(cats.dtype)
+
+
+def _temp_path(path):
+    # dot prefix and .tmp suffix keep the Blender watcher away from it
+    return path.with_name(f".{path.stem}.{os.getpid()}.tmp{path.suffix}")
+
+
+def _publish(path, data):
+    """Write data under a temporary name next to path, then rename it in.
+
+    The rename is atomic, so the Blender watcher never sees a partial file.
+    """
+    tmp = _temp_path(path)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    _current_profile().add_bytes(len(data))
+
+
+def _encode_masks(cats, base_cat, use_subtract, packed=False):
+    if packed:
+        pixels, palette, manifest = packed_masks(cats, base_cat, use_subtract)
+        if "bands" in manifest and not manifest["bands"]:
+            return {}  # no tree class, as with separate masks
+        text = {"tl-manifest": json.dumps(manifest)}
+        return {PACKED_MASK: _encode_png(pixels, palette, text)}
+    return {
+        f"{name}.png": _encode_png(pixels)
+        for name, pixels in class_masks(cats, base_cat, use_subtract).items()
+    }
+
+
+def _publish_all(exported, watch):
+    watch.mkdir(parents=True, exist_ok=True)
+    for filename, data in exported.items():
+        _publish(watch / filename, data)
+
+
+SCAN_PREFIX = "scan_"
+SCAN_MANIFEST = "manifest.json"
+
+
+def _scan_dir(watch, seq):
+    return watch / f"{SCAN_PREFIX}{seq:020d}"
+
+
+def _stage_scan(watch, seq):
+    """Empty hidden staging directory for the artifacts of scan seq."""
+    stage = _temp_path(_scan_dir(watch, seq))
+    shutil.rmtree(stage, ignore_errors=True)
+    stage.mkdir(parents=True)
+    return stage
+
+
+def _publish_scan(exported, watch, scan_id, seq, keep=2, staged=False):
+    """Publish the artifacts of one scan as a versioned directory.
+
+    The artifacts and a manifest with their sizes and checksums are
+    written to a hidden staging directory that is renamed to scan_<seq>
+    in one step, so the Blender add-on sees a whole scan or nothing.
+    With staged, the artifacts are in the staging directory already
+    (_stage_scan) and only the manifest is written. Only the newest keep
+    scan directories are left in the watch folder.
+    """
+    final = _scan_dir(watch, seq)
+    stage = _temp_path(final) if staged else _stage_scan(watch, seq)
+    artifacts = {}
+    for filename, data in exported.items():
+        if not staged:
+            (stage / filename).write_bytes(data)
+            _current_profile().add_bytes(len(data))
+        artifacts[filename] = {
+            "size": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+        }
+    manifest = {"scan": scan_id, "seq": seq, "artifacts": artifacts}
+    (stage / SCAN_MANIFEST).write_text(json.dumps(manifest))
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(stage, final)
+
+    scans = sorted(p for p in watch.glob(SCAN_PREFIX + "*") if p.is_dir())
+    for old in scans[:-keep]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _write_bw_rules(path):
+    with open(path, "w") as f:
+        f.write("0 0:0:0\n1 255:255:255\n")  # 0 -> black, 1 -> white
+
+
+def _export_masks_gdal(patches, base_cat, folder, use_subtract, bw_rules, env):
     cats_raw = gscript.read_command(
         "r.describe", flags="1ni", map=patches, env=env
     ).strip()
     cats = [int(cat) for cat in cats_raw.splitlines()] if cats_raw else []
     toexport = []
 
-    # mask export settings
-    USE_SUBTRACT = kwargs.get(
-        "use_subtract", True
-    )  # only True if Blender is set to SUBTRACT
-    BW_RULES = kwargs.get("bw_rules", "/tmp/mask_bw.rules")
-    if not os.path.exists(BW_RULES):
-        with open(BW_RULES, "w") as f:
-            f.write("0 0:0:0\n1 255:255:255\n")  # 0 -> black, 1 -> white
-
     # build one mask per class we care about
     for cat in cats:
         if cat in base_cat:
@@ -234,7 +1069,7 @@ def run_patches(
             continue
 
         mask = f"patch_{name}"
-        if USE_SUBTRACT:
+        if use_subtract:
             # black inside (plant), white outside (don’t) -> for SUBTRACT
             expr = f"{mask}=if(isnull({patches}),1.0, if({patches}=={cat},0.0,1.0))"
         else:
@@ -242,40 +1077,1603 @@ def run_patches(
             expr = f"{mask}=if(isnull({patches}),0.0, if({patches}=={cat},1.0,0.0))"
 
         gscript.mapcalc(expr, env=env, overwrite=True)
-        gscript.run_command("r.colors", map=mask, rules=BW_RULES, env=env)
+        gscript.run_command("r.colors", map=mask, rules=bw_rules, env=env)
         toexport.append(mask)
 
-    # --- export masks as PNGs and drop them into Watch/ ---
-    root = Path(blender_path)
-    watch = root / "Watch"
-    watch.mkdir(parents=True, exist_ok=True)
+    # --- export masks as PNGs straight into Watch/ or a scan's staging ---
+    folder.mkdir(parents=True, exist_ok=True)
+    # no .aux.xml from GDAL's PAM, and the PNG driver writes no world file
+    gdal_env = dict(env, GDAL_PAM_ENABLED="NO")
 
     # lock export region so PNGs match Blender plane
+    exported = {}
     for png in toexport:
-        out = root / f"{png}.png"
+        dest = folder / f"{png}.png"
+        tmp = _temp_path(dest)
         try:
             gscript.run_command(
                 "r.out.gdal",
                 input=png,
-                output=str(out),
+                output=str(tmp),
                 format="PNG",
                 type="Byte",
                 createopt="ZLEVEL=1,INTERLACE=0",
-                flags="c",  # avoid extra sidecars when possible
-                env=env,
+                flags="c",
+                env=gdal_env,
                 overwrite=True,
             )
         except CalledModuleError:
             # fallback if GDAL export not available
+            import grass.jupyter as gj
+
             img = gj.Map(use_region=True, width=2048)
             img.d_rast(map=png)
-            img.save(out)
+            img.save(tmp)
+        os.replace(tmp, dest)
+        exported[dest.name] = dest.read_bytes()
+        _current_profile().add_bytes(len(exported[dest.name]))
+    return exported
+
+
+# --- parallel steps ------------------------------------------------------
+
+
+class StepPool:
+    """Process pool for the independent steps of one session's scans.
+
+    Each session has its own, so tables running side by side get one
+    pool each and resizing one does not shut down another's. The lock
+    keeps threads sharing a pool from replacing it under each other.
+    Workers start from a fork server (start_method): forking TL itself,
+    with the export worker, display timers and GUI threads running,
+    could hand the workers locks held by those threads. The workers
+    import this module by name, so the steps must be module functions.
+    """
+
+    start_method = "forkserver"
+
+    def __init__(self):
+        self.workers = 0
+        self._executor = None
+        self._lock = threading.Lock()
 
-        dest = watch / out.name
-        shutil.copyfile(out, dest)
+    def executor(self, workers):
+        with self._lock:
+            if self._executor is None or self.workers != workers:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                # workers attaching shared memory must share this tracker
+                resource_tracker.ensure_running()
+                # let the workers import this module however TL loaded it
+                here = os.path.dirname(os.path.abspath(__file__))
+                if here not in sys.path:
+                    sys.path.append(here)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                )
+                self.workers = workers
+            return self._executor
+
+    def discard(self, executor):
+        """Drop a broken executor, unless it was replaced already."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_default_pool = StepPool()  # for callers outside a session
+
+
+def _isolated_env(env):
+    """Copy of env pinned to the current region through GRASS_REGION.
+
+    A g.region in one step then cannot change the region of another.
+    """
+    return dict(env, GRASS_REGION=gscript.region_env(env=env))
+
+
+def run_steps(steps, workers, local=None, pool=None):
+    """Run independent steps concurrently.
+
+    steps and local map a step name to (function, args). steps go to pool
+    (a StepPool) with the given number of workers, local steps run in this
+    process meanwhile (they may use caches of this process). Returns a
+    dict of results by step name; if the pool breaks or was shut down,
+    steps run sequentially.
+    """
+    local = local or {}
+    pool = pool or _default_pool
+    executor = None
+    futures = {}
+    try:
+        executor = pool.executor(workers)
+        for name, (func, args) in steps.items():
+            futures[name] = executor.submit(func, *args)
+    except (BrokenProcessPool, RuntimeError):
+        pool.discard(executor)
+    results = {name: func(*args) for name, (func, args) in local.items()}
+    for name, (func, args) in steps.items():
+        try:
+            results[name] = futures[name].result()
+        except (KeyError, BrokenProcessPool):
+            pool.discard(executor)
+            results[name] = func(*args)
+    return results
+
+
+def _rli_step(raster, index, env, rli):
+    try:
+        return _rli_index(raster, index, env, rli)
+    except CalledModuleError:
+        return None
+
+
+def _parallel_indices(
+    patch_rast,
+    cats2,
+    region,
+    engine,
+    workers,
+    env,
+    rli,
+    water,
+    style=None,
+    tiled=None,
+    backend=None,
+    pool=None,
+    tile=256,
+):
+    """Indices, remediation and optionally a styling step of one scan in parallel.
+
+    rli and water are the r.li paths and the water buffer cache, tiled
+    the TiledIndices of the "tiled" engine, backend the execution backend
+    and pool the StepPool of the scan, tile the tile size of the "pool"
+    engine. Returns the results list (remediation first) and the styling
+    result.
+    """
+    backend = backend or SubprocessBackend()
+    step_env = _isolated_env(env)
+    steps = {}
+    local = {}
+    if tiled is not None:
+        # keeps its tiles in this process
+        cell_area = region["nsres"] * region["ewres"]
+        local["indices"] = (tiled.update, (cats2, cell_area))
+    elif engine == "pool" and csgraph is not None:
+        # fans out over the same pool itself
+        cell_area = region["nsres"] * region["ewres"]
+        local["indices"] = (
+            pool_landscape_indices,
+            (cats2, cell_area, workers, tile, pool),
+        )
+    elif engine == "numpy" and csgraph is not None:
+        cell_area = region["nsres"] * region["ewres"]
+        steps["indices"] = (landscape_indices, (cats2, cell_area))
+    elif backend.has_cells(patch_rast, cats2, env):
+        # the five r.li modules are independent of each other
+        for index in RLI_INDICES:
+            steps[index] = (_rli_step, (patch_rast, index, step_env, rli))
+    if style:
+        func, args = style
+        steps["style"] = (func, args + (step_env,))
+
+    if ndimage is not None:
+        local["remediation"] = (
+            _remediation,
+            (cats2, region, env, water, backend.find_file),
+        )
+    else:
+        steps["remediation"] = (_grass_remediation, (patch_rast, step_env))
+
+    # pool workers count their spawns themselves
+    steps = {name: (_counted, step) for name, step in steps.items()}
+    results = run_steps(steps, workers, local, pool)
+    for name in steps:
+        results[name], spawned = results[name]
+        for module, n in spawned.items():
+            backend.add_spawn(module, n)
+    if "indices" in results:
+        results_list = results["indices"]
+    elif all(results.get(index) is not None for index in RLI_INDICES):
+        results_list = [results[index] for index in RLI_INDICES]
+    else:
+        # no patch cells, or a failed r.li step zeroes them all as before
+        results_list = [0.0 for _ in RLI_INDICES]
+    results_list.insert(0, results["remediation"])
+    return results_list, results.get("style")
+
+
+# --- vector styling ------------------------------------------------------
+
+PATCH_VECTOR = "patches2gen"  # smoothed vector you’ll color/display
+
+
+def _color_rules(env):
+    """Find the patch color rules: ("file", path), ("text", rules) or None."""
+    # prefer your fixed file; else training_areas; else local file
+    rules_path = Path("/home/buas/Documents/TL_Activities/patch_colors.txt")
+    if rules_path.exists():
+        return "file", str(rules_path)
+    if _raster_exists("training_areas", env):
+        rules_txt = gscript.read_command("r.colors.out", map="training_areas", env=env)
+        rules_txt = "\n".join(
+            ln
+            for ln in rules_txt.splitlines()
+            if ln and not ln.startswith(("nv", "default"))
+        )
+        if rules_txt:
+            return "text", rules_txt
+        # 3) fallback: file next to this script
+        alt = Path(__file__).with_name("patch_colors.txt")
+        if alt.exists():
+            return "file", str(alt)
+    return None
+
+
+def _color_patches(patch_vec, rules, env):
+    # vector styling with the rules from _color_rules
+    if rules is None:
+        return
+    kind, value = rules
+    if kind == "file":
+        gscript.run_command("v.colors", map=patch_vec, rules=value, env=env)
+    else:
+        gscript.write_command(
+            "v.colors", map=patch_vec, rules="-", stdin=value, env=env
+        )
+
+
+class VectorCache:
+    """Generalized patch vectors keyed on the patch raster content.
+
+    Each cached result is kept as a copy named after its key, so a patch
+    layout seen before is restored with one g.copy instead of going
+    through generalization again. Hold lock while restoring or storing.
+    claim() only takes a short internal lock, so the main thread does not
+    wait for a styling in progress; a claimed entry is not evicted before
+    its restore().
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.current = None  # key of what PATCH_VECTOR holds now
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._index = threading.Lock()
+        self._stored = OrderedDict()
+        self._claims = {}  # key -> restores still to come
+
+    def claim(self, key):
+        """Keep the entry of key for a later restore(); False if there is none."""
+        with self._index:
+            if key not in self._stored:
+                return False
+            self._claims[key] = self._claims.get(key, 0) + 1
+            return True
+
+    def invalidate(self):
+        """Mark PATCH_VECTOR as holding no entry, e.g. after a failed styling."""
+        with self._index:
+            self.current = None
+
+    def forget(self):
+        """Drop all entries, e.g. after their mapset went away."""
+        with self._index:
+            self.current = None
+            self._stored.clear()
+            self._claims.clear()
+
+    def restore(self, key, env):
+        """Put the claimed entry of key into PATCH_VECTOR; False if it is gone."""
+        with self._index:
+            claims = self._claims.pop(key, 0)
+            if claims > 1:
+                self._claims[key] = claims - 1
+            stored = self._stored.get(key)
+            if stored is None:
+                return False
+            self.hits += 1
+            self._stored.move_to_end(key)
+            if key == self.current:
+                return True
+        gscript.run_command(
+            "g.copy", vector=(stored, PATCH_VECTOR), env=env, overwrite=True
+        )
+        self.current = key
+        return True
+
+    def store(self, key, env):
+        self.misses += 1
+        stored = f"{PATCH_VECTOR}_{key[:12]}"
+        gscript.run_command(
+            "g.copy", vector=(PATCH_VECTOR, stored), env=env, overwrite=True
+        )
+        with self._index:
+            self._stored[key] = stored
+            self._stored.move_to_end(key)
+            self.current = key
+            evicted = []
+            for old in list(self._stored):
+                if len(self._stored) <= max(self.maxsize, 1):
+                    break
+                if old != key and old not in self._claims:
+                    evicted.append(self._stored.pop(old))
+        for name in evicted:
+            gscript.run_command(
+                "g.remove", flags="f", type="vector", name=name, env=env
+            )
+
+
+def _prepare_styling(
+    patches, cats2, base_cat, smoothing, size, rules, scan_id, env, cache
+):
+    """Main-thread part of the styling of one scan.
+
+    Returns (key, source). source is None when the cache already has the
+    result for these patches and settings, and the entry is claimed for
+    _apply_styling; otherwise it is this scan's copy of the
+    input for _style_patches: base_cat areas extracted from the patches
+    vector (snakes) or a size x size mode filter of the patch raster
+    (raster). Being a copy, the next scan cannot overwrite it while a
+    worker styles it.
+    """
+    digest = hashlib.blake2b(cats2.tobytes(), digest_size=16)
+    digest.update(repr((cats2.shape, smoothing, size, rules)).encode())
+    key = digest.hexdigest()
+    if cache.claim(key):
+        return key, None
+    source = f"{patches}2_src{scan_id}"
+    if smoothing == "raster":
+        gscript.run_command(
+            "r.neighbors",
+            input=patches + "2",
+            output=source,
+            method="mode",
+            size=size,
+            env=env,
+            overwrite=True,
+        )
+    else:
+        # drop base_cat areas from the one vectorization of patches
+        gscript.run_command(
+            "v.extract",
+            flags="r",
+            input=patches,
+            output=source,
+            type="area",
+            cats=",".join(str(c) for c in base_cat),
+            env=env,
+            overwrite=True,
+        )
+    return key, source
+
+
+def _apply_styling(
+    key, source, smoothing, rules, env, cache, cancelled=lambda: False, scratch=None
+):
+    with cache.lock:
+        previous = cache.current
+        if source is None:
+            cache.restore(key, env)
+        elif _style_patches(source, smoothing, rules, env, cancelled):
+            cache.store(key, env)
+        else:
+            cache.invalidate()  # generalization may have overwritten it
+        if scratch is not None and cache.current not in (previous, None):
+            scratch.promote("vector", PATCH_VECTOR)
+
+
+def _style_patches(source, smoothing, rules, env, cancelled=lambda: False):
+    """Smooth and color one scan's patches for display; best effort.
+
+    Returns True when PATCH_VECTOR was rebuilt; the input map is removed.
+    """
+    source_type = "raster" if smoothing == "raster" else "vector"
+    try:
+        if cancelled():
+            return False
+        if smoothing == "raster":
+            gscript.run_command(
+                "r.to.vect",
+                flags="sv",
+                input=source,
+                output=PATCH_VECTOR,
+                type="area",
+                env=env,
+                overwrite=True,
+            )
+        else:
+            gscript.run_command(
+                "v.generalize",
+                input=source,
+                type="area",
+                output=PATCH_VECTOR,
+                method="snakes",
+                threshold=100,
+                env=env,
+                overwrite=True,
+            )
+        if cancelled():
+            return False
+        _color_patches(PATCH_VECTOR, rules, env)
+        return True
+    except CalledModuleError:
+        # styling is optional; keep going even if it fails
+        return False
+    finally:
+        gscript.run_command(
+            "g.remove", flags="f", type=source_type, name=source, env=env
+        )
+
+
+# --- scratch mapset ------------------------------------------------------
+class ScratchMapset:
+    """Mapset next to the user's one for the intermediate maps of a scan.
+
+    With tmpfs, the mapset directory is a symlink into it, so the maps
+    rewritten on every scan never touch the disk. env runs modules in
+    the scratch mapset with the user mapset on its search path; finals
+    are copied back with promote().
+    """
+
+    def __init__(self, env, name="tl_scratch", tmpfs=None):
+        gisenv = gscript.gisenv(env=env)
+        location = os.path.join(gisenv["GISDBASE"], gisenv["LOCATION_NAME"])
+        self.name = name
+        self.user_env = env
+        self.user_mapset = gisenv["MAPSET"]
+        self.user_path = os.path.join(location, self.user_mapset)
+        self.path = os.path.join(location, name)
+        self.scans = 0
+        self._target = None
+        if not os.path.isdir(self.path):
+            if os.path.lexists(self.path):
+                os.remove(self.path)  # link into a tmpfs emptied by a reboot
+            if tmpfs and os.path.isdir(tmpfs):
+                self._target = tempfile.mkdtemp(prefix=name + "_", dir=tmpfs)
+                os.symlink(self._target, self.path)
+            else:
+                os.makedirs(self.path)
+        elif os.path.islink(self.path):
+            self._target = os.path.realpath(self.path)
+        self.sync_region()
+
+        fd, self.gisrc = tempfile.mkstemp(prefix="gisrc_" + name + "_")
+        with os.fdopen(fd, "w") as f:
+            f.write(
+                "GISDBASE: {}\nLOCATION_NAME: {}\nMAPSET: {}\nGUI: text\n".format(
+                    gisenv["GISDBASE"], gisenv["LOCATION_NAME"], name
+                )
+            )
+        self.env = dict(env, GISRC=self.gisrc)
+        # the user mapset ahead of PERMANENT, as in the user's own env
+        gscript.run_command(
+            "g.mapsets",
+            operation="set",
+            mapset=tuple(dict.fromkeys((name, self.user_mapset, "PERMANENT"))),
+            env=self.env,
+        )
+        atexit.register(self.close)
+
+    def sync_region(self):
+        """Give the scratch mapset the current region of the user mapset."""
+        shutil.copyfile(
+            os.path.join(self.user_path, "WIND"), os.path.join(self.path, "WIND")
+        )
+
+    def begin_scan(self, cleanup_every=10):
+        self.scans += 1
+        if cleanup_every and self.scans % cleanup_every == 0:
+            self.cleanup()
+        self.sync_region()
+
+    def promote(self, element, name):
+        gscript.run_command(
+            "g.copy",
+            **{element: (f"{name}@{self.name}", name)},
+            env=self.user_env,
+            overwrite=True,
+        )
+
+    def cleanup(self, keep=r"^patches2(gen|_src)"):
+        """Remove all maps but the ones matching keep.
+
+        By default these are the ones a running export job may still use.
+        """
+        gscript.run_command(
+            "g.remove",
+            flags="rf",
+            type=("raster", "vector"),
+            pattern=".*",
+            exclude=keep or "^$",
+            env=self.env,
+        )
+
+    def close(self):
+        """Drop the whole mapset, on tmpfs or on disk."""
+        atexit.unregister(self.close)
+        if os.path.islink(self.path):
+            os.remove(self.path)
+        if self._target:
+            shutil.rmtree(self._target, ignore_errors=True)
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        if os.path.exists(self.gisrc):
+            os.remove(self.gisrc)
+
+
+# --- background export ---------------------------------------------------
+
+
+class ExportWorker:
+    """Run Blender export jobs on a background pool, newest scan wins.
+
+    A job is called with a ``cancelled()`` callable that turns true as soon
+    as a newer job is submitted; jobs check it before their slow steps and
+    skip them, so stale styling is dropped instead of queueing up.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="patches-export"
+        )
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.last_error = None
+        self.latencies = deque(maxlen=100)
+
+    def submit(self, job):
+        with self._lock:
+            self._generation += 1
+            self.submitted += 1
+            generation = self._generation
+        return self._pool.submit(self._run, job, generation, time.perf_counter())
+
+    def _run(self, job, generation, queued):
+        def cancelled():
+            return generation != self._generation
+
+        with self._lock:
+            self._running += 1
+        try:
+            job(cancelled)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.last_error = repr(e)
+            gscript.warning(f"Blender export failed: {e}")
+        else:
+            with self._lock:
+                if cancelled():
+                    self.cancelled += 1
+                else:
+                    self.completed += 1
+                    self.latencies.append(time.perf_counter() - queued)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def status(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            return {
+                "running": self._running,
+                "pending": self.submitted
+                - self.completed
+                - self.cancelled
+                - self.failed
+                - self._running,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "failed": self.failed,
+                "last_error": self.last_error,
+                "last_latency": self.latencies[-1] if self.latencies else None,
+                "median_latency": (
+                    latencies[len(latencies) // 2] if latencies else None
+                ),
+            }
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+# --- dashboard ------------------------------------------------------------
+class DisplayCoalescer:
+    """Rate-limit dashboard updates and drop the ones that change nothing.
+
+    Values within tolerance (one number, or one per value) of the last
+    posted ones are suppressed. Otherwise they are posted right away if
+    interval seconds passed since the last post, else held back; a newer
+    update replaces the held one, and the latest is posted on the trailing
+    edge of the interval.
+    """
+
+    def __init__(self, post, interval=0.2, tolerance=0.0):
+        self.post = post
+        self.interval = interval
+        self.tolerance = tolerance
+        self.posted = 0
+        self.suppressed = 0
+        self._last = None
+        self._last_time = float("-inf")
+        self._pending = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _unchanged(self, values):
+        if self._last is None or len(values) != len(self._last):
+            return False
+        tolerance = np.broadcast_to(self.tolerance, len(values))
+        return all(
+            abs(new - old) <= tol
+            for new, old, tol in zip(values, self._last, tolerance)
+        )
+
+    def update(self, values):
+        values = list(values)
+        with self._lock:
+            if self._pending is not None:
+                self._pending = None
+                self.suppressed += 1  # superseded before it was posted
+            if self._unchanged(values):
+                self.suppressed += 1
+                return
+            wait = self._last_time + self.interval - time.monotonic()
+            if wait > 0:
+                self._pending = values
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._trailing)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._mark(values)
+        self.post(values)
+
+    def _mark(self, values):
+        self._last = values
+        self._last_time = time.monotonic()
+        self.posted += 1
+
+    def _trailing(self):
+        with self._lock:
+            self._timer = None
+            values, self._pending = self._pending, None
+            if values is None:
+                return
+            self._mark(values)
+        self.post(values)
+
+    def flush(self):
+        """Post a held update now instead of at the end of the interval."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self._trailing()
+
+    def status(self):
+        with self._lock:
+            return {
+                "posted": self.posted,
+                "suppressed": self.suppressed,
+                "pending": self._pending is not None,
+            }
+
+
+# --- execution backends ---------------------------------------------------
+class SubprocessBackend:
+    """Run every GRASS call of a scan as its module.
+
+    Calls are counted by module as spawned or, in ArrayBackend, as served
+    in-process. Spawns are counted in start_command, which every
+    grass.script call goes through, on the threads inside counting(); the
+    steps run in the process pool report theirs back (_counted).
+    """
+
+    def __init__(self):
+        self.spawned = {}
+        self.served = {}
+        self._lock = threading.Lock()
+        _count_spawns()
+
+    @contextmanager
+    def counting(self):
+        """Count the module spawns of this thread for this backend."""
+        previous = getattr(_active, "backend", None)
+        _active.backend = self
+        try:
+            yield
+        finally:
+            _active.backend = previous
+
+    def add_spawn(self, module, n=1):
+        with self._lock:
+            self.spawned[module] = self.spawned.get(module, 0) + n
+
+    def _serve(self, module):
+        with self._lock:
+            self.served[module] = self.served.get(module, 0) + 1
+        _current_profile().add_served()
+
+    def find_file(self, name, element="cell", env=None):
+        return gscript.find_file(name=name, element=element, env=env)
+
+    def region(self, env):
+        return gscript.region(env=env)
+
+    def read_cats(self, name, env):
+        return _read_cats(name, env)
+
+    def patch_raster(self, output, patches, base_cat, env):
+        """Make output, patches without base_cat, and return its categories.
+
+        The region is set to output.
+        """
+        gscript.mapcalc(_patch_expression(output, patches, base_cat), env=env)
+        gscript.run_command("g.region", raster=output, env=env)
+        return self.read_cats(output, env)
+
+    def materialize(self, name):
+        """Make sure the raster name exists before a module reads it."""
+
+    def has_cells(self, raster, cats, env):
+        return _rli_has_cells(raster, env)
+
+    def remove_mask(self, env):
+        # clear any MASK (best effort)
+        try:
+            gscript.run_command("r.mask", flags="r", env=env)
+        except Exception:
+            pass
+
+    def status(self):
+        with self._lock:
+            return {"spawned": dict(self.spawned), "served": dict(self.served)}
+
+
+def _counted(func, args):
+    """Pool step wrapper: func(*args) and the modules it spawned, by name."""
+    _count_spawns()
+    counter = SubprocessBackend()
+    with counter.counting():
+        result = func(*args)
+    return result, counter.spawned
+
+
+def _patch_expression(output, patches, base_cat):
+    # raster without base_cat values
+    return "{p2} = if({p} != {cl1}, int({p}), null())".format(
+        p2=output, p=patches, cl1=base_cat[0]
+    )
+
+
+def _gisrc(env):
+    """GISDBASE, LOCATION_NAME and MAPSET read from the GISRC file of env."""
+    path = (env if env is not None else os.environ).get("GISRC")
+    if not path or not os.path.isfile(path):
+        return None
+    values = {}
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.partition(":")
+            if sep:
+                values[key.strip()] = value.strip()
+    if not all(k in values for k in ("GISDBASE", "LOCATION_NAME", "MAPSET")):
+        return None
+    return values
+
+
+def _parse_region(pairs):
+    """A region dict like gscript.region from WIND style key: value pairs."""
+    wind = {}
+    for pair in pairs:
+        key, sep, value = pair.partition(":")
+        if sep:
+            wind[key.strip()] = value.strip()
+    region = {
+        "n": float(wind["north"]),
+        "s": float(wind["south"]),
+        "e": float(wind["east"]),
+        "w": float(wind["west"]),
+        "nsres": float(wind["n-s resol"]),
+        "ewres": float(wind["e-w resol"]),
+        "rows": int(wind["rows"]),
+        "cols": int(wind["cols"]),
+    }
+    region["cells"] = region["rows"] * region["cols"]
+    for key, name in (("projection", "proj"), ("zone", "zone")):
+        if name in wind:
+            region[key] = int(wind[name])
+    return region
+
+
+class ArrayBackend(SubprocessBackend):
+    """Serve what a scan needs in-process where it can.
+
+    The raster without base_cat is computed from the patches array and
+    only written to GRASS (materialize) when a module has to read it; its
+    cell count comes from the array. Files and the region are read from
+    the mapset directories, and the last category array read is reused
+    while raster and region stay the same. Anything else, or an env
+    without a readable GISRC, goes to the modules as before.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._deferred = {}
+        self._last_read = (None, None)
+
+    def find_file(self, name, element="cell", env=None):
+        gisenv = _gisrc(env)
+        if gisenv is None:
+            return super().find_file(name, element, env)
+        self._serve("g.findfile")
+        location = os.path.join(gisenv["GISDBASE"], gisenv["LOCATION_NAME"])
+        name, _, mapset = name.partition("@")
+        if mapset:
+            mapsets = [mapset]
+        else:
+            search_path = os.path.join(location, gisenv["MAPSET"], "SEARCH_PATH")
+            mapsets = [gisenv["MAPSET"], "PERMANENT"]
+            if os.path.isfile(search_path):
+                with open(search_path) as f:
+                    mapsets = [gisenv["MAPSET"]] + [m.strip() for m in f if m.strip()]
+        for mapset in mapsets:
+            path = os.path.join(location, mapset, element, name)
+            if os.path.exists(path):
+                fullname = f"{name}@{mapset}"
+                return {
+                    "name": name,
+                    "mapset": mapset,
+                    "fullname": fullname,
+                    "file": path,
+                }
+        return {"name": "", "mapset": "", "fullname": "", "file": ""}
+
+    def region(self, env):
+        env = env if env is not None else os.environ
+        gisenv = _gisrc(env)
+        if env.get("GRASS_REGION"):
+            self._serve("g.region")
+            return _parse_region(env["GRASS_REGION"].split(";"))
+        if gisenv is None or env.get("WIND_OVERRIDE"):
+            return super().region(env)
+        self._serve("g.region")
+        wind = os.path.join(
+            gisenv["GISDBASE"], gisenv["LOCATION_NAME"], gisenv["MAPSET"], "WIND"
+        )
+        with open(wind) as f:
+            return _parse_region(f)
+
+    def read_cats(self, name, env):
+        stamp = _raster_stamp(name, env, self.find_file)
+        key = (name, stamp, _region_key(self.region(env)))
+        last_key, cats = self._last_read
+        if stamp is not None and key == last_key:
+            self._serve("r.out.bin")
+            return cats
+        cats = super().read_cats(name, env)
+        self._last_read = (key, cats)
+        return cats
+
+    def patch_raster(self, output, patches, base_cat, env):
+        # output lies in the current region, so no g.region is needed
+        self._serve("r.mapcalc")
+        self._serve("g.region")
+        self._deferred[output] = (_patch_expression(output, patches, base_cat), env)
+        cats = self.read_cats(patches, env)
+        return np.where(cats == base_cat[0], NULL_CAT, cats)
+
+    def materialize(self, name):
+        deferred = self._deferred.pop(name, None)
+        if deferred is not None:
+            expression, env = deferred
+            gscript.mapcalc(expression, env=env)
+
+    def has_cells(self, raster, cats, env):
+        self._serve("r.univar")
+        return bool(np.any(cats != NULL_CAT))
+
+    def remove_mask(self, env):
+        gisenv = _gisrc(env)
+        if (
+            gisenv is None
+            or self.find_file(f"MASK@{gisenv['MAPSET']}", env=env)["name"]
+        ):
+            super().remove_mask(env)
+        else:
+            self._serve("r.mask")
+
+
+BACKENDS = {"subprocess": SubprocessBackend, "array": ArrayBackend}
+
+
+# --- main workflow --------------------------------------------------------
+
+
+_session_ids = itertools.count(1)
+
+
+class PatchesSession:
+    """Patch analysis for a stream of scans of one Tangible Landscape session.
+
+    Setup that does not change between scans (r.li config, mask and color
+    rules, GRASS version) is done once on first use; the scan and vector
+    caches, the water buffer, the classifier, the scratch mapset, the
+    step pool, the export worker and the profiler stay warm from one scan
+    to the next.
+    options are run_patches keyword arguments and serve as defaults for
+    process().
+    """
+
+    def __init__(self, blender_path, eventHandler, env, **options):
+        self.blender_path = blender_path
+        self.watch = Path(blender_path) / "Watch"
+        self.eventHandler = eventHandler
+        self.env = env
+        self.options = options
+        self.major = _grass_major()
+        self.scan_cache = ScanCache(options.get("cache_size", 8))
+        self.vector_cache = VectorCache()
+        self.water = {}
+        self.classifier = {}
+        self.tiled = None
+        self.backend = None
+        self.scratch = None
+        self.export_worker = None
+        self.profiler = None
+        self.display = DisplayCoalescer(self._post_display)
+        self.pool = StepPool()
+        # r.li writes its results to one folder shared by all sessions
+        self.rli_prefix = f"index_{os.getpid()}_{next(_session_ids)}_"
+        self._setup = {}
+        self._scan_ids = itertools.count(1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _once(self, name, func, *args):
+        # session-constant setup, done on first use
+        if name not in self._setup:
+            self._setup[name] = func(*args)
+        return self._setup[name]
+
+    def _profile(self, scan_id, kwargs):
+        if not kwargs.get("profile", False):
+            return _NO_PROFILE
+        log, summary = kwargs.get("profile_log"), kwargs.get("profile_summary", False)
+        profiler = self.profiler
+        if profiler is None or (profiler.log, profiler.summary_enabled) != (
+            log,
+            summary,
+        ):
+            profiler = self.profiler = StageProfiler(log, summary)
+        return profiler.scan(scan_id)
+
+    def _scratch_mapset(self, kwargs):
+        """The scratch mapset, or None when disabled."""
+        name = kwargs.get("scratch_mapset", "tl_scratch")
+        if not name:
+            return None
+        if self.scratch is not None and self.scratch.name == name:
+            return self.scratch
+        if self.scratch is not None:
+            self.scratch.close()
+            with self.vector_cache.lock:
+                self.vector_cache.forget()
+        self.scratch = ScratchMapset(
+            self.env, name, kwargs.get("scratch_tmpfs", "/dev/shm")
+        )
+        return self.scratch
+
+    def _post_display(self, values):
+        event = updateDisplay(value=values)
+        self.eventHandler.postEvent(
+            receiver=self.eventHandler.activities_panel, event=event
+        )
+
+    def _update_display(self, values, kwargs):
+        self.display.interval = kwargs.get("display_interval", 0.2)
+        self.display.tolerance = kwargs.get("display_tolerance", 0.0)
+        self.display.update(values)
+
+    def _backend(self, kind):
+        if type(self.backend) is not BACKENDS[kind]:
+            self.backend = BACKENDS[kind]()
+        return self.backend
+
+    def _tiled(self, tile):
+        if self.tiled is None or self.tiled.tile != tile:
+            self.tiled = TiledIndices(tile)
+        return self.tiled
+
+    def _export_worker(self, workers):
+        worker = self.export_worker
+        if worker is None or worker.workers != workers:
+            if worker is not None:
+                worker.shutdown(wait=False)
+            worker = self.export_worker = ExportWorker(workers)
+        return worker
+
+    def _publish(self, masks, scan_id, seq, kwargs):
+        if kwargs.get("handoff", "manifest") == "manifest":
+            _publish_scan(masks, self.watch, scan_id, seq)
+        else:
+            _publish_all(masks, self.watch)
+
+    def stream(self, scans, **kwargs):
+        """Process (scanned_elev, scanned_color) pairs, yielding the results."""
+        for scan in scans:
+            yield self.process(*scan, **kwargs)
+
+    def process(self, scanned_elev, scanned_color, real_elev=None, **kwargs):
+        """Run one scan through the pipeline; returns the dashboard values."""
+        kwargs = dict(self.options, **kwargs)
+        backend = self._backend(kwargs.get("backend", "array"))
+        with backend.counting():
+            return self._process(scanned_elev, scanned_color, backend, kwargs)
+
+    def _process(self, scanned_elev, scanned_color, backend, kwargs):
+        env, watch = self.env, self.watch
+        topo = "topo_saved"
+        scan_id = next(self._scan_ids)
+        seq = time.time_ns()  # orders scans across sessions
+        profile = self._profile(scan_id, kwargs)
+
+        # 0) skip the whole pipeline if this scan was already processed
+        scan_key = None
+        if kwargs.get("scan_cache", True):
+            with profile.stage("cache"):
+                self.scan_cache.maxsize = kwargs.get(
+                    "cache_size", self.scan_cache.maxsize
+                )
+                # remediation and the masks also depend on these
+                extra = (
+                    _raster_stamp("waterall", env, backend.find_file),
+                    tuple(kwargs.get(k, v) for k, v in SCAN_KEY_OPTIONS.items()),
+                )
+                scan_key = _scan_key(
+                    scanned_elev,
+                    scanned_color,
+                    env,
+                    kwargs.get("cache_tolerance", 0),
+                    extra,
+                )
+                cached = self.scan_cache.get(scan_key)
+            if cached is not None:
+                with profile.stage("dashboard"):
+                    self._update_display(cached["results"], kwargs)
+                self._restore_scan(
+                    cached, scan_key, scan_id, seq, profile, backend, kwargs
+                )
+                return list(cached["results"])
+
+        # intermediates go to the scratch mapset (wenv) when there is one
+        scratch = self._scratch_mapset(kwargs)
+        wenv = env
+        if scratch is not None:
+            scratch.begin_scan(kwargs.get("scratch_cleanup_every", 10))
+            wenv = scratch.env
+
+        # 1) detect patches (cloth colors -> categories)
+        patches = "patches"
+        with profile.stage("classify"):
+            if kwargs.get("classifier", "superpixels") == "centroid" and csgraph:
+                _centroid_classify(
+                    patches,
+                    scanned_color,
+                    env,
+                    self.classifier,
+                    kwargs.get("training_group"),
+                    minsize=10,
+                    find_file=backend.find_file,
+                )
+            else:
+                analyses.classify_colors(
+                    new=patches,
+                    group=scanned_color,
+                    compactness=2,
+                    threshold=0.3,
+                    minsize=10,
+                    useSuperPixels=True,
+                    env=env,
+                )
+        with profile.stage("vectorize"):
+            gscript.run_command(
+                "r.to.vect",
+                flags="svt",
+                input=patches,
+                output=patches,
+                type="area",
+                env=wenv,
+            )
+
+        base_cat = [7]  # categories to ignore (mixed, etc.)
+
+        # 2) landscape indices (robust against empty inputs)
+        patch_rast = patches + "2"
+        engine = kwargs.get("indices_engine", "numpy")
+        async_export = kwargs.get("async_export", True)
+        parallel = kwargs.get("parallel_steps", False)
+        smoothing = kwargs.get("smoothing", "snakes")  # or "raster"
+        with profile.stage("indices"):
+            cats2 = backend.patch_raster(patch_rast, patches, base_cat, wenv)
+            region = backend.region(wenv)
+            if engine == "rli" or csgraph is None or ndimage is None:
+                backend.materialize(patch_rast)  # r.li or r.grow read it
+
+        # the snapshot the styling works on (None if the cache has it)
+        style = None
+        with profile.stage("styling"):
+            rules = self._once("color_rules", _color_rules, env)
+            if smoothing == "raster":
+                backend.materialize(patch_rast)
+            try:
+                style = _prepare_styling(
+                    patches,
+                    cats2,
+                    base_cat,
+                    smoothing,
+                    kwargs.get("smoothing_size", 5),
+                    rules,
+                    scan_id,
+                    wenv,
+                    self.vector_cache,
+                )
+            except CalledModuleError:
+                pass  # styling is optional; keep going even if it fails
+        style_key = style[0] if style else None
+
+        with profile.stage("indices"):
+            tiled = None
+            if engine == "tiled" and csgraph is not None:
+                tiled = self._tiled(kwargs.get("tile_size", 64))
+            if parallel:
+                # 2) + 3) and the styling chain run side by side
+                style_step = None
+                if style and style[1] and not async_export:
+                    style_step = (_style_patches, (style[1], smoothing, rules))
+                results_list, styled = _parallel_indices(
+                    patch_rast,
+                    cats2,
+                    region,
+                    engine,
+                    kwargs.get("workers", os.cpu_count()),
+                    wenv,
+                    self._once("rli", _rli_setup, self.major, self.rli_prefix),
+                    self.water,
+                    style=style_step,
+                    tiled=tiled,
+                    backend=backend,
+                    pool=self.pool,
+                    tile=kwargs.get("tile_size", 256),
+                )
+                if style_step:
+                    with self.vector_cache.lock:
+                        if styled:
+                            self.vector_cache.store(style[0], wenv)
+                            if scratch is not None:
+                                scratch.promote("vector", PATCH_VECTOR)
+                        else:
+                            self.vector_cache.invalidate()
+                    style = None
+            elif tiled is not None:
+                results_list = tiled.update(cats2, region["nsres"] * region["ewres"])
+            elif engine == "pool" and csgraph is not None:
+                results_list = pool_landscape_indices(
+                    cats2,
+                    region["nsres"] * region["ewres"],
+                    kwargs.get("workers", os.cpu_count()),
+                    kwargs.get("tile_size", 256),
+                    self.pool,
+                )
+            elif engine == "numpy" and csgraph is not None:
+                results_list = landscape_indices(
+                    cats2, region["nsres"] * region["ewres"]
+                )
+            else:
+                results_list = _rli_indices(
+                    patch_rast,
+                    wenv,
+                    self._once("rli", _rli_setup, self.major, self.rli_prefix),
+                    backend.has_cells(patch_rast, cats2, wenv),
+                )
+
+        if not parallel:
+            # 3) remediation percentage (only if waterall exists)
+            with profile.stage("remediation"):
+                if ndimage is not None:
+                    perc = _remediation(
+                        cats2, region, wenv, self.water, backend.find_file
+                    )
+                else:
+                    perc = _grass_remediation(patch_rast, wenv)
+            results_list.insert(0, perc)  # prepend remediation %
+
+        # 4) update dashboard (if TL UI is running)
+        with profile.stage("dashboard"):
+            self._update_display(results_list, kwargs)
+
+        # 5) export patches to Blender
+        with profile.stage("styling"):
+            gscript.mapcalc("scanned_scan_int = int({})".format(scanned_elev), env=wenv)
+            style_env = _isolated_env(wenv)
+            if style and not async_export:
+                _apply_styling(
+                    *style,
+                    smoothing,
+                    rules,
+                    style_env,
+                    self.vector_cache,
+                    scratch=scratch,
+                )
+                style = None
+
+            backend.remove_mask(env)
+            gscript.run_command("g.region", raster=topo, align=topo, env=env)
+            if scratch is not None:
+                scratch.sync_region()
+
+        # 6) per-class masks for Blender (black=plant, white=don’t)
+        use_subtract = kwargs.get("use_subtract", True)  # only if Blender uses SUBTRACT
+        packed = kwargs.get("mask_format", "separate") == "packed"
+        # level of detail: a downsample factor or a target pixel size
+        lod = {"factor": kwargs.get("mask_factor"), "res": kwargs.get("mask_res")}
+        exported = cats = mask_region = None
+        with profile.stage("masks"):
+            if kwargs.get("mask_export", "bulk") == "gdal" and not packed:
+                # reads the patches map, so it cannot wait for the worker
+                bw_rules = kwargs.get("bw_rules", "/tmp/mask_bw.rules")
+                self._once(("bw_rules", bw_rules), _write_bw_rules, bw_rules)
+                mask_rast, mask_env = patches, wenv
+                if lod["factor"] or lod["res"]:
+                    full = gscript.region(env=wenv)
+                    rows, cols = mask_shape(
+                        (full["rows"], full["cols"]),
+                        full["nsres"],
+                        full["ewres"],
+                        **lod,
+                    )
+                    if (rows, cols) != (full["rows"], full["cols"]):
+                        # same extent, fewer cells
+                        mask_env = dict(
+                            wenv,
+                            GRASS_REGION=gscript.region_env(
+                                raster=topo, rows=rows, cols=cols, env=wenv
+                            ),
+                        )
+                        mask_rast = patches + "_lod"
+                        gscript.run_command(
+                            "r.resamp.stats",
+                            flags="w",
+                            input=patches,
+                            output=mask_rast,
+                            method="mode",
+                            env=mask_env,
+                            overwrite=True,
+                        )
+                # with a manifest, straight into the scan's staging folder
+                gdal_dir = watch
+                if kwargs.get("handoff", "manifest") == "manifest":
+                    gdal_dir = _stage_scan(watch, seq)
+                exported = _export_masks_gdal(
+                    mask_rast, base_cat, gdal_dir, use_subtract, bw_rules, mask_env
+                )
+            else:
+                cats = backend.read_cats(patches, env)
+                mask_region = backend.region(env)  # topo, not the scan
+
+        def export(cancelled):
+            # masks first: they are cheap, only the styling may be dropped
+            masks = exported
+            if masks is None:
+                with profile.stage("masks"):
+                    shape = mask_shape(
+                        cats.shape, mask_region["nsres"], mask_region["ewres"], **lod
+                    )
+                    mask_cats = downsample_mode(cats, shape)
+                    masks = _encode_masks(mask_cats, base_cat, use_subtract, packed)
+                with profile.stage("export"):
+                    self._publish(masks, scan_id, seq, kwargs)
+            elif kwargs.get("handoff", "manifest") == "manifest":
+                with profile.stage("export"):
+                    _publish_scan(masks, watch, scan_id, seq, staged=True)
+            if scan_key is not None:
+                self.scan_cache.put(
+                    scan_key,
+                    {
+                        "results": list(results_list),
+                        "masks": masks,
+                        "style_key": style_key,
+                    },
+                )
+            if style:
+                with profile.stage("styling"):
+                    _apply_styling(
+                        *style,
+                        smoothing,
+                        rules,
+                        style_env,
+                        self.vector_cache,
+                        cancelled,
+                        scratch=scratch,
+                    )
+            if cancelled():
+                profile.finish(cancelled=True)
+            else:
+                profile.finish()
+
+        # what Blender has once the submitted jobs ran
+        self.scan_cache.last_key = scan_key
+        self._export(export, backend, kwargs)
+        return results_list
+
+    def _export(self, job, backend, kwargs):
+        # on the export worker, or right away without async_export
+        if kwargs.get("async_export", True):
+
+            def counted(cancelled):
+                with backend.counting():
+                    job(cancelled)
+
+            self._export_worker(kwargs.get("export_workers", 1)).submit(counted)
+        else:
+            job(lambda: False)
+
+    def _restore_scan(self, cached, scan_key, scan_id, seq, profile, backend, kwargs):
+        """Bring Blender and the styled vector back to a cached scan.
+
+        Goes through the export worker like a processed scan, after the
+        jobs of the scans before it, and supersedes their styling.
+        """
+        # an earlier state came back, Blender has or will get newer masks
+        republish = scan_key != self.scan_cache.last_key
+        self.scan_cache.last_key = scan_key
+        scratch = self._scratch_mapset(kwargs)
+        wenv = scratch.env if scratch is not None else self.env
+        style_key = cached.get("style_key")
+        restore = style_key is not None and self.vector_cache.claim(style_key)
+
+        def job(cancelled):
+            if republish:
+                with profile.stage("export"):
+                    self._publish(cached["masks"], scan_id, seq, kwargs)
+            if restore:
+                with profile.stage("styling"):
+                    _apply_styling(
+                        style_key,
+                        None,
+                        None,
+                        None,
+                        wenv,
+                        self.vector_cache,
+                        scratch=scratch,
+                    )
+            profile.finish(cache_hit=True)
+
+        self._export(job, backend, kwargs)
+
+    def export_status(self):
+        """Status and latency of the background Blender export worker."""
+        return self.export_worker.status() if self.export_worker else {}
+
+    def profile_summary(self):
+        """Rolling p50/p95 stage wall times of the profiled scans so far."""
+        return self.profiler.summary() if self.profiler else {}
+
+    def display_status(self):
+        """Dashboard updates posted and suppressed so far."""
+        return self.display.status()
+
+    def backend_status(self):
+        """GRASS calls served in-process and spawned so far, by module."""
+        return self.backend.status() if self.backend else {}
+
+    def close(self, wait=True):
+        """Flush the dashboard, stop the workers, drop the scratch mapset."""
+        self.display.flush()
+        if self.export_worker is not None:
+            self.export_worker.shutdown(wait=wait)
+            self.export_worker = None
+        self.pool.shutdown(wait=wait)
+        rli = self._setup.get("rli")
+        if rli is not None:
+            for index in RLI_INDICES:
+                try:
+                    os.remove(os.path.join(rli[1], rli[2] + index))
+                except OSError:
+                    pass
+        if self.scratch is not None:
+            self.scratch.close()
+            self.scratch = None
+        with self.vector_cache.lock:
+            self.vector_cache.forget()
+
+
+_session = {"instance": None}
+
+
+def run_patches(
+    real_elev, scanned_elev, scanned_color, blender_path, eventHandler, env, **kwargs
+):
+    session = _session["instance"]
+    if session is None or (session.blender_path, session.env.get("GISRC")) != (
+        blender_path,
+        env.get("GISRC"),
+    ):
+        if session is not None:
+            session.close(wait=False)
+        session = _session["instance"] = PatchesSession(blender_path, eventHandler, env)
+    session.eventHandler, session.env = eventHandler, env
+    return session.process(scanned_elev, scanned_color, real_elev, **kwargs)
+
+
+def export_status():
+    """Status and latency of the background Blender export worker."""
+    session = _session["instance"]
+    return session.export_status() if session else {}
+
+
+def profile_summary():
+    """Rolling p50/p95 stage wall times of the profiled scans so far."""
+    session = _session["instance"]
+    return session.profile_summary() if session else {}
+
+
+def display_status():
+    """Dashboard updates posted and suppressed so far."""
+    session = _session["instance"]
+    return session.display_status() if session else {}
+
+
+def backend_status():
+    """GRASS calls served in-process and spawned so far, by module."""
+    session = _session["instance"]
+    return session.backend_status() if session else {}
+
+
+# --- multi-table scheduling ----------------------------------------------
+class TableScheduler:
+    """Run the scans of several tables on a bounded pool of threads.
+
+    Each table has its own PatchesSession (GRASS env, Watch folder, caches)
+    and runs at most one scan at a time. Each table also needs its own
+    mapset: patches, patches2gen and the temporary maps of classify_colors
+    have fixed names there, so two tables in one mapset would overwrite
+    each other's results. A table keeps only its newest
+    waiting scan; an older one that has not started is dropped. Free
+    threads go to the waiting table that used the least time relative to
+    its priority, so a table with slow scans cannot starve the others.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.tables = {}
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="patches-table"
+        )
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def add_table(self, name, blender_path, eventHandler, env, priority=1, **options):
+        """Register a table; options are its run_patches keyword arguments.
+
+        Raises ValueError if env runs in the mapset of another table.
+        """
+        gisenv = gscript.gisenv(env=env)
+        mapset = tuple(gisenv[k] for k in ("GISDBASE", "LOCATION_NAME", "MAPSET"))
+        # own scratch mapset, and a step pool with a fair share of the cores
+        options.setdefault("scratch_mapset", f"tl_scratch_{name}")
+        options.setdefault("workers", max(1, (os.cpu_count() or 1) // self.workers))
+        with self._lock:
+            for other, table in self.tables.items():
+                if table["mapset"] == mapset and other != name:
+                    raise ValueError(
+                        f"Table {name} would share mapset {mapset[2]} with {other}"
+                    )
+            used = [t["used"] for t in self.tables.values()]
+            self.tables[name] = {
+                "mapset": mapset,
+                "session": PatchesSession(blender_path, eventHandler, env, **options),
+                "priority": priority,
+                "used": min(used) if used else 0.0,  # no catching up on arrival
+                "pending": None,
+                "running": False,
+                "submitted": 0,
+                "processed": 0,
+                "dropped": 0,
+                "failed": 0,
+                "results": None,
+            }
+
+    def submit(self, name, scanned_elev, scanned_color, real_elev=None, **kwargs):
+        """Queue a scan of table name, replacing its waiting one if any."""
+        with self._lock:
+            table = self.tables[name]
+            if table["pending"] is not None:
+                table["dropped"] += 1
+            table["pending"] = ((scanned_elev, scanned_color, real_elev), kwargs)
+            table["submitted"] += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        with self._lock:
+            while self._running < self.workers:
+                waiting = [
+                    (t["used"] / t["priority"], name)
+                    for name, t in self.tables.items()
+                    if t["pending"] is not None and not t["running"]
+                ]
+                if not waiting:
+                    return
+                _, name = min(waiting)
+                table = self.tables[name]
+                scan, table["pending"] = table["pending"], None
+                table["running"] = True
+                self._running += 1
+                self._pool.submit(self._run, name, scan)
+
+    def _run(self, name, scan):
+        table = self.tables[name]
+        (scanned_elev, scanned_color, real_elev), kwargs = scan
+        started = time.perf_counter()
+        try:
+            results = table["session"].process(
+                scanned_elev, scanned_color, real_elev, **kwargs
+            )
+        except Exception as e:
+            with self._lock:
+                table["failed"] += 1
+            gscript.warning(f"Scan of table {name} failed: {e}")
+        else:
+            with self._lock:
+                table["processed"] += 1
+                table["results"] = results
+        finally:
+            with self._lock:
+                table["used"] += time.perf_counter() - started
+                table["running"] = False
+                self._running -= 1
+            self._dispatch()
+
+    def status(self):
+        with self._lock:
+            return {
+                name: {
+                    key: table[key]
+                    for key in (
+                        "priority",
+                        "used",
+                        "running",
+                        "submitted",
+                        "processed",
+                        "dropped",
+                        "failed",
+                        "results",
+                    )
+                }
+                for name, table in self.tables.items()
+            }
 
-        # clean sidecars Blender doesn’t need
-        for ext in (".aux.xml", ".prj", ".wld", ".tfw", ".pgw"):
-            p = Path(str(dest) + ext)
-            if p.exists():
-                p.unlink()
+    def close(self, wait=True):
+        """Finish the running scans and close the table sessions."""
+        self._pool.shutdown(wait=wait)
+        for table in self.tables.values():
+            table["session"].close(wait=wait)